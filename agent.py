@@ -6,65 +6,688 @@ import platform
 import subprocess
 import os
 from dotenv import load_dotenv
+from spool import SampleSpool
 import uuid
+import gzip
+import json
+import threading
+from collections import deque, OrderedDict
+from itertools import islice
 
 # Load environment variables
 load_dotenv()
 
 # ADDRESS of the machine running server.py
 API_URL = "https://system-monitor-silk.vercel.app/api/update"
-COMMAND_URL = "https://system-monitor-silk.vercel.app/api/commands"
-ACK_URL = "https://system-monitor-silk.vercel.app/api/command/ack"
+ACKS_URL = "https://system-monitor-silk.vercel.app/api/commands/ack"
+BATCH_URL = "https://system-monitor-silk.vercel.app/api/update/batch"
+WAIT_URL = "https://system-monitor-silk.vercel.app/api/commands/wait"
 
 # Device Authentication
 DEVICE_ID = os.getenv("DEVICE_ID") or str(uuid.uuid4())
 USER_ID = os.getenv("USER_ID") or "demo-user"
 DEVICE_TOKEN = os.getenv("DEVICE_TOKEN") or "demo-token"
 
+# Sampling period in seconds (every tick is aligned to this grid)
+UPDATE_INTERVAL = float(os.getenv("AGENT_INTERVAL") or 2)
+
+# Collection interval per metric group in seconds. Groups that are not due on
+# a tick reuse their last sampled value (0 = sample on every tick).
+COLLECTION_INTERVALS = {
+    "gpu": float(os.getenv("AGENT_GPU_INTERVAL") or 10),
+    "disks": float(os.getenv("AGENT_DISK_INTERVAL") or 30),
+    "battery": float(os.getenv("AGENT_BATTERY_INTERVAL") or 30),
+    "processes": float(os.getenv("AGENT_PROCESS_INTERVAL") or 10)
+}
+
+# Upload once every N samples (1 = every tick); samples in between are buffered
+UPLOAD_EVERY = max(int(os.getenv("AGENT_UPLOAD_EVERY") or 1), 1)
+
+# Samples kept while the API is unreachable (oldest are dropped first) and
+# the most samples sent in a single batch request
+BUFFER_SIZE = int(os.getenv("AGENT_BUFFER_SIZE") or 1800)
+MAX_BATCH_SIZE = 100
+
+# Unsent samples spill to this directory so they survive restarts and long
+# offline periods (set AGENT_SPOOL_DIR to an empty value to keep them in memory only)
+SPOOL_DIR = os.getenv("AGENT_SPOOL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool"))
+SPOOL_MAX_MB = float(os.getenv("AGENT_SPOOL_MAX_MB") or 50)
+# Spooled batches replayed per upload, so catching up after an outage
+# never holds the collection tick for long
+SPOOL_BATCHES_PER_TICK = 3
+# After a failed upload, samples are only buffered for a backoff that
+# doubles per consecutive failure up to this many seconds
+UPLOAD_BACKOFF_MAX = 60
+
+# Hold a long-poll connection open so remote commands arrive immediately
+# instead of with the next update response. Opt-in (AGENT_PUSH_COMMANDS=1):
+# it suits a long-running server, while on serverless hosting every idle
+# agent would keep a function invocation open. The wait stays below the
+# server's maxDuration (vercel.json).
+PUSH_COMMANDS = os.getenv("AGENT_PUSH_COMMANDS", "0") == "1"
+COMMAND_WAIT_TIMEOUT = 25
+
+# Remote commands run on their own threads so they never pause collection.
+# Each command type belongs to a group with its own concurrency limit, and a
+# command that runs past its timeout is reported as failed.
+COMMAND_GROUPS = {
+    "shutdown": "power", "restart": "power", "sleep": "power", "logoff": "power",
+    "power_high": "power_profile", "power_balanced": "power_profile", "power_saver": "power_profile"
+}
+COMMAND_LIMITS = {"open_app": 4, "close_app": 4}  # Per group; every other group runs one at a time
+COMMAND_TIMEOUTS = {"screenshot": 30, "open_app": 10}
+DEFAULT_COMMAND_TIMEOUT = 20
+
+# How often cached host facts are rebuilt in seconds (0 = never, build once)
+STATIC_REFRESH_INTERVAL = float(os.getenv("AGENT_STATIC_REFRESH") or 0)
+
+# Comma-separated tags for targeting bulk commands at a group of machines (e.g. "lab-2,kiosk")
+DEVICE_TAGS = [tag.strip() for tag in os.getenv("AGENT_TAGS", "").split(",") if tag.strip()]
+
 if not os.getenv("DEVICE_ID"):
     print("⚠️ WARNING: No DEVICE_ID in .env file. Using temporary ID.")
     print("⚠️ Please run device_register.py to set up proper authentication.")
 
-def execute_command(command, params):
-    """Execute remote commands received from server"""
+def create_session(device_id, user_id, device_token):
+    """Pooled keep-alive HTTP session with the device auth headers prebuilt"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "X-Device-ID": device_id,
+        "X-User-ID": user_id,
+        "Authorization": f"Bearer {device_token}"
+    })
+    return session
+
+# Shared by every request the agent makes, so the TCP+TLS connection is reused
+session = create_session(DEVICE_ID, USER_ID, DEVICE_TOKEN)
+
+class CpuSampler:
+    """Non-blocking CPU usage sampler.
+
+    Keeps the previous cpu_times snapshot and computes overall and per-core
+    usage from the delta since the last call, so the loop never has to park
+    inside psutil.cpu_percent(interval=1).
+    """
+
+    def __init__(self):
+        self._last = psutil.cpu_times(percpu=True)
+
+    @staticmethod
+    def _busy_and_total(times):
+        total = sum(times)
+        # On Linux guest time is already included in user/nice
+        total -= getattr(times, "guest", 0) + getattr(times, "guest_nice", 0)
+        idle = times.idle + getattr(times, "iowait", 0)
+        return total - idle, total
+
+    @staticmethod
+    def _percent(busy_delta, total_delta):
+        if total_delta <= 0:
+            return 0.0
+        return round(min(max(busy_delta / total_delta * 100, 0.0), 100.0), 1)
+
+    def sample(self):
+        """Return (usage, per_core) since the previous sample"""
+        current = psutil.cpu_times(percpu=True)
+        per_core = []
+        busy_sum = total_sum = 0.0
+        for old, new in zip(self._last, current):
+            old_busy, old_total = self._busy_and_total(old)
+            new_busy, new_total = self._busy_and_total(new)
+            busy_delta = new_busy - old_busy
+            total_delta = new_total - old_total
+            per_core.append(self._percent(busy_delta, total_delta))
+            busy_sum += busy_delta
+            total_sum += total_delta
+        self._last = current
+        return self._percent(busy_sum, total_sum), per_core
+
+class FixedRateScheduler:
+    """Drift-free fixed-rate ticker.
+
+    Deadlines are kept on the monotonic clock so the period does not grow with
+    collection or network latency. The first tick is aligned to a wall-clock
+    multiple of the interval, which keeps samples from different hosts on the
+    same grid. When a cycle overruns, the missed ticks are skipped (coalesced
+    into one immediate tick) instead of being replayed back to back.
+
+    The monotonic clock stops while the machine is suspended (Linux, macOS),
+    so the wall-clock offset is re-synced, and the grid re-aligned, whenever
+    it drifts by more than one interval.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.last_lateness = 0.0
+        self._wall_offset = None
+        self._resync()
+
+    def _resync(self):
+        """Re-anchor to the wall clock if it moved away from the monotonic one; True if it did"""
+        offset = time.time() - time.monotonic()
+        if self._wall_offset is not None and abs(offset - self._wall_offset) <= self.interval:
+            return False
+        self._wall_offset = offset
+        wall_now = time.monotonic() + offset
+        self._next_tick = time.monotonic() + (self.interval - wall_now % self.interval)
+        return True
+
+    def wait(self):
+        """Sleep until the next tick and return its scheduled wall-clock timestamp"""
+        self._resync()
+        now = time.monotonic()
+        lateness = now - self._next_tick
+        if lateness > 0:
+            self.overruns += 1
+            missed = int(lateness // self.interval)
+            if missed:
+                self.skipped_ticks += missed
+                self._next_tick += missed * self.interval
+                print(f"⚠️ Collection fell behind by {lateness:.2f}s, skipped {missed} tick(s)")
+        else:
+            time.sleep(-lateness)
+            if self._resync():
+                return self.wait()  # Suspended while sleeping: wait for the re-aligned tick
+        self.last_lateness = max(lateness, 0.0)
+        tick = self._next_tick
+        self._next_tick += self.interval
+        return round(tick + self._wall_offset, 3)
+
+_cpu_model = None
+_static_facts = None
+_static_facts_built_at = 0.0
+
+def detect_cpu_model():
+    """Detect the CPU marketing name (runs the slow probes once per process)"""
+    global _cpu_model
+    if _cpu_model:
+        return _cpu_model
+
+    cpu_model = None
+
+    # Method 1: Try Windows Registry (most reliable)
+    if platform.system() == "Windows":
+        try:
+            import winreg
+            key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, 
+                                r"HARDWARE\DESCRIPTION\System\CentralProcessor\0")
+            cpu_model = winreg.QueryValueEx(key, "ProcessorNameString")[0].strip()
+            winreg.CloseKey(key)
+        except:
+            pass
+
+    # Method 2: Try WMIC if registry failed
+    if not cpu_model:
+        try:
+            result = subprocess.run(['wmic', 'cpu', 'get', 'name'], 
+                                  capture_output=True, text=True, timeout=2, shell=True)
+            lines = result.stdout.strip().split('\n')
+            if len(lines) > 1:
+                cpu_model = lines[1].strip()
+        except:
+            pass
+
+    # Method 3: Fallback to platform.processor()
+    if not cpu_model or "Family" in str(cpu_model) or "Model" in str(cpu_model):
+        cpu_model = platform.processor()
+
+    # Final fallback
+    if not cpu_model or cpu_model.strip() == "":
+        cpu_model = f"{platform.machine()} Processor"
+
+    _cpu_model = cpu_model
+    return _cpu_model
+
+def get_static_facts():
+    """Return host facts that do not change between samples.
+
+    Built on first use and reused for every payload; rebuilt every
+    STATIC_REFRESH_INTERVAL seconds when that is set. The CPU model is never
+    re-detected, so the wmic fallback runs at most once per process.
+    """
+    global _static_facts, _static_facts_built_at
+    now = time.monotonic()
+    if _static_facts is not None and (
+        not STATIC_REFRESH_INTERVAL or now - _static_facts_built_at < STATIC_REFRESH_INTERVAL
+    ):
+        return _static_facts
+
+    gpu_model = "No GPU detected"
+    try:
+        gpus = GPUtil.getGPUs()
+        if gpus:
+            gpu_model = gpus[0].name
+    except Exception:
+        pass
+
+    _static_facts = {
+        "os_name": platform.system(),
+        "os_version": platform.version(),
+        "os_release": platform.release(),
+        "hostname": platform.node(),
+        "architecture": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_model": detect_cpu_model(),
+        "gpu_model": gpu_model,
+        "python_version": platform.python_version(),
+        "boot_time": psutil.boot_time(),
+        "core_count_physical": psutil.cpu_count(logical=False),
+        "core_count_logical": psutil.cpu_count(logical=True),
+        "tags": DEVICE_TAGS
+    }
+    _static_facts_built_at = now
+    return _static_facts
+
+class TieredCollector:
+    """Runs each metric group at its own interval and caches the last value"""
+
+    def __init__(self, intervals):
+        self.intervals = intervals
+        self._values = {}
+        self._collected_at = {}
+
+    def get(self, group, collect, now):
+        """Return the group's value, resampling it only when its interval has elapsed"""
+        interval = self.intervals.get(group, 0)
+        last = self._collected_at.get(group)
+        if last is None or now - last >= interval:
+            self._values[group] = collect()
+            self._collected_at[group] = now
+        return self._values[group]
+
+def collect_gpus():
+    """GPU inventory and load (GPUtil shells out to nvidia-smi)"""
+    gpu_details = []
+    for gpu in GPUtil.getGPUs():
+        gpu_details.append({
+            "id": gpu.id,
+            "name": gpu.name,
+            "load_percent": round(gpu.load * 100, 1),
+            "memory_used_mb": round(gpu.memoryUsed, 2),
+            "memory_total_mb": round(gpu.memoryTotal, 2),
+            "memory_free_mb": round(gpu.memoryFree, 2),
+            "memory_percent": round((gpu.memoryUsed / gpu.memoryTotal) * 100, 1),
+            "temperature_c": gpu.temperature
+        })
+    return gpu_details
+
+def collect_disks():
+    """Usage of every mounted partition"""
+    disk_info = {}
+    for partition in psutil.disk_partitions():
+        try:
+            usage = psutil.disk_usage(partition.mountpoint)
+            drive_letter = partition.device.replace(':\\', '')
+            disk_info[drive_letter] = {
+                "usage_percent": round(usage.percent, 1),
+                "total_gb": round(usage.total / (1024**3), 2),
+                "used_gb": round(usage.used / (1024**3), 2),
+                "free_gb": round(usage.free / (1024**3), 2),
+                "filesystem": partition.fstype,
+                "mount_point": partition.mountpoint
+            }
+        except PermissionError:
+            continue
+    return disk_info
+
+def collect_battery():
+    """Battery state, or None on machines without a battery"""
+    battery = psutil.sensors_battery()
+    if not battery:
+        return None
+
+    time_left = battery.secsleft
+    if time_left == psutil.POWER_TIME_UNLIMITED:
+        time_left_str = "Charging/Plugged"
+        time_left_minutes = None
+    elif time_left == psutil.POWER_TIME_UNKNOWN:
+        time_left_str = "Unknown"
+        time_left_minutes = None
+    else:
+        time_left_minutes = round(time_left / 60, 1)
+        time_left_str = f"{time_left_minutes} minutes"
+
+    return {
+        "percent": battery.percent,
+        "plugged": battery.power_plugged,
+        "time_left_minutes": time_left_minutes,
+        "time_left_str": time_left_str
+    }
+
+def collect_processes():
+    """Top 5 processes by CPU and by memory"""
+    processes = []
+    for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
+        try:
+            processes.append(proc.info)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+
+    top_cpu_processes = sorted(
+        [p for p in processes if p['cpu_percent'] is not None], 
+        key=lambda x: x['cpu_percent'], 
+        reverse=True
+    )[:5]
+
+    top_memory_processes = sorted(
+        [p for p in processes if p['memory_percent'] is not None], 
+        key=lambda x: x['memory_percent'], 
+        reverse=True
+    )[:5]
+
+    return {
+        "top_cpu": top_cpu_processes,
+        "top_memory": top_memory_processes,
+        "total_processes": len(processes)
+    }
+
+class DeltaEncoder:
+    """Encodes successive payloads as one full snapshot followed by deltas.
+
+    Every message carries a sequence number. A delta holds only the top-level
+    fields whose value changed; dict fields that kept the same keys are sent
+    as a "patch" with just the changed sub-keys. After reset() (server asked
+    for a resync, or a send failed) the next message is a full snapshot again.
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self._last = None
+
+    def reset(self):
+        self._last = None
+
+    def encode(self, payload):
+        self.seq += 1
+        if self._last is None:
+            message = dict(payload, seq=self.seq, full=True)
+        else:
+            message = {
+                "device_id": payload["device_id"],
+                "user_id": payload["user_id"],
+                "seq": self.seq,
+                "full": False
+            }
+            patch = {}
+            for key, value in payload.items():
+                old = self._last.get(key)
+                if key in message or value == old:
+                    continue
+                if isinstance(value, dict) and isinstance(old, dict) and value.keys() == old.keys():
+                    patch[key] = {k: v for k, v in value.items() if old[k] != v}
+                else:
+                    message[key] = value
+            if patch:
+                message["patch"] = patch
+        self._last = payload
+        return message
+
+def _gzip_json(data):
+    return gzip.compress(json.dumps(data).encode("utf-8"), compresslevel=6)
+
+GZIP_JSON_HEADERS = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+
+def post_batch(session, encoder, payloads, acks=None):
+    """POST consecutive samples as gzipped deltas, resending in full when the server asks to resync.
+
+    A single sample goes to /api/update, several go to /api/update/batch.
+    Command acks ride along with the request.
+    """
+    def send():
+        messages = [encoder.encode(payload) for payload in payloads]
+        if len(messages) == 1:
+            body = dict(messages[0], acks=acks) if acks else messages[0]
+            return session.post(API_URL, data=_gzip_json(body), headers=GZIP_JSON_HEADERS, timeout=10)
+        body = {"samples": messages, "acks": acks or []}
+        return session.post(BATCH_URL, data=_gzip_json(body), headers=GZIP_JSON_HEADERS, timeout=30)
+
+    try:
+        response = send()
+        if response.status_code == 409:
+            # Server has no baseline for us (restart or sequence gap) - resend in full
+            encoder.reset()
+            response = send()
+    except Exception:
+        encoder.reset()
+        raise
+    if response.status_code != 200:
+        encoder.reset()
+    return response
+
+def open_spool():
+    """Open the on-disk sample spool, or return None if it is disabled or unusable"""
+    if not SPOOL_DIR:
+        return None
+    try:
+        return SampleSpool(SPOOL_DIR, max_bytes=int(SPOOL_MAX_MB * 1024 * 1024))
+    except OSError as e:
+        print(f"⚠️ Could not open spool at {SPOOL_DIR}: {e}")
+        return None
+
+class SampleUploader:
+    """Buffers samples locally and uploads them in batches.
+
+    Samples stay in a bounded in-memory buffer until the server accepts them.
+    With a spool, samples that could not be sent (or that overflow the
+    buffer) are written to disk and replayed oldest first after reconnect,
+    a few batches per upload; without one, the oldest samples are dropped
+    once the buffer is full.
+    With upload_every > 1 samples are only sent every N ticks, one request
+    per batch. After a failed upload nothing is sent until a backoff
+    expires, so an unreachable server does not stall every tick.
+
+    Remote commands come back in the upload responses and their acks are
+    sent with the next upload, so one request per tick replaces the old
+    update + poll + ack round trips. On ticks that only buffer a sample,
+    accumulated acks go out together in one /api/commands/ack request.
+    """
+
+    def __init__(self, session, upload_every=UPLOAD_EVERY, capacity=BUFFER_SIZE, spool=None):
+        self.session = session
+        self.upload_every = upload_every
+        self.encoder = DeltaEncoder()
+        self.buffer = deque(maxlen=capacity)
+        self.spool = spool
+        self.dropped = 0
+        self.pending_acks = []
+        self.commands = []
+        self._ack_lock = threading.Lock()  # Acks arrive from command worker threads
+        self._failures = 0
+        self._retry_at = 0.0  # time.monotonic() before which uploads are skipped
+
+    def add(self, payload):
+        """Queue a sample; returns the last upload response, or None if it was only buffered"""
+        if len(self.buffer) == self.buffer.maxlen:
+            if self.spool is not None:
+                self._spill()
+            else:
+                self.dropped += 1
+        self.buffer.append(payload)
+        if self.backing_off():
+            return None
+        if len(self.buffer) < self.upload_every:
+            self.flush_acks()
+            return None
+        return self.flush()
+
+    def backing_off(self):
+        """True while uploads are paused after a failure"""
+        return time.monotonic() < self._retry_at
+
+    def ack(self, command_id, success, duration=None, output=None):
+        """Queue a command result to piggyback on the next upload"""
+        result = {"id": command_id, "success": success}
+        if duration is not None:
+            result["duration"] = round(duration, 3)
+        if output:
+            result["output"] = output
+        with self._ack_lock:
+            self.pending_acks.append(result)
+
+    def flush_acks(self):
+        """Send accumulated acks in one request when no sample upload is due to carry them"""
+        with self._ack_lock:
+            acks = list(self.pending_acks)
+        if not acks:
+            return
+        try:
+            response = self.session.post(ACKS_URL, data=_gzip_json({"acks": acks}), headers=GZIP_JSON_HEADERS, timeout=10)
+        except requests.exceptions.RequestException:
+            return  # Kept for the next upload
+        if response.status_code == 200:
+            with self._ack_lock:
+                del self.pending_acks[:len(acks)]
+
+    def take_commands(self):
+        """Return commands delivered since the last call"""
+        commands, self.commands = self.commands, []
+        return commands
+
+    def flush(self):
+        """Upload spooled samples, then buffered ones, oldest first; spill to disk on failure"""
+        try:
+            response = self._flush_spool()
+            if self.spool is not None and not self.spool.is_empty():
+                # Still replaying: queue new samples behind the spool to keep upload order
+                self._spill()
+            elif response is None or response.status_code == 200:
+                response = self._flush_buffer() or response
+        except Exception:
+            self._spill()
+            self._back_off()
+            raise
+        if response is not None and response.status_code != 200:
+            self._spill()
+            self._back_off()
+        else:
+            self._failures = 0
+        return response
+
+    def _back_off(self):
+        self._failures += 1
+        delay = min(2 ** self._failures, UPLOAD_BACKOFF_MAX)
+        self._retry_at = time.monotonic() + delay
+
+    def _flush_spool(self):
+        response = None
+        for _ in range(SPOOL_BATCHES_PER_TICK):
+            if self.spool is None or self.spool.is_empty():
+                break
+            batch = self.spool.peek(MAX_BATCH_SIZE)
+            if not batch:
+                break
+            response = self._post(batch)
+            if response.status_code != 200:
+                break
+            self.spool.consume(len(batch))
+        return response
+
+    def _flush_buffer(self):
+        response = None
+        while self.buffer:
+            batch = list(islice(self.buffer, MAX_BATCH_SIZE))
+            response = self._post(batch)
+            if response.status_code != 200:
+                break
+            for _ in batch:
+                self.buffer.popleft()
+        return response
+
+    def _post(self, batch):
+        with self._ack_lock:
+            acks = list(self.pending_acks)
+        response = post_batch(self.session, self.encoder, batch, acks)
+        if response.status_code == 200:
+            with self._ack_lock:
+                del self.pending_acks[:len(acks)]
+            try:
+                self.commands.extend(response.json().get("commands", []))
+            except ValueError:
+                pass
+        return response
+
+    def _spill(self):
+        if self.spool is not None and self.buffer:
+            self.spool.extend(self.buffer)
+            self.buffer.clear()
+
+class CommandListener(threading.Thread):
+    """Background long-poll on /api/commands/wait.
+
+    Holds one request open until the server has a command for this device,
+    then hands the commands to `handler` and immediately waits again.
+    """
+
+    def __init__(self, session, handler):
+        super().__init__(daemon=True)
+        self.session = session
+        self.handler = handler
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                response = self.session.get(
+                    WAIT_URL, params={"timeout": COMMAND_WAIT_TIMEOUT}, timeout=COMMAND_WAIT_TIMEOUT + 10
+                )
+                if response.status_code != 200:
+                    self._stop_event.wait(10)
+                    continue
+                commands = response.json().get("commands", [])
+                if commands:
+                    self.handler(commands)
+            except Exception:
+                # Server unreachable - commands still arrive with update responses
+                self._stop_event.wait(10)
+
+def execute_command(command, params, timeout=None):
+    """Execute remote commands received from server (external programs are killed after timeout)"""
     try:
         cmd_type = command.lower()
         
         # Power commands
         if cmd_type == "shutdown":
             print("⚠️ Executing SHUTDOWN...")
-            os.system("shutdown /s /t 5")
+            subprocess.run(["shutdown", "/s", "/t", "5"], timeout=timeout)
             return True
             
         elif cmd_type == "restart":
             print("⚠️ Executing RESTART...")
-            os.system("shutdown /r /t 5")
+            subprocess.run(["shutdown", "/r", "/t", "5"], timeout=timeout)
             return True
             
         elif cmd_type == "sleep":
             print("💤 Executing SLEEP...")
-            os.system("rundll32.exe powrprof.dll,SetSuspendState 0,1,0")
+            subprocess.run(["rundll32.exe", "powrprof.dll,SetSuspendState", "0,1,0"], timeout=timeout)
             return True
             
         elif cmd_type == "logoff":
             print("👋 Executing LOGOFF...")
-            os.system("shutdown /l")
+            subprocess.run(["shutdown", "/l"], timeout=timeout)
             return True
             
         # Power profile commands
         elif cmd_type == "power_high":
             print("⚡ Setting power profile: High Performance")
-            subprocess.run(["powercfg", "/setactive", "8c5e7fda-e8bf-4a96-9a85-a6e23a8c635c"])
+            subprocess.run(["powercfg", "/setactive", "8c5e7fda-e8bf-4a96-9a85-a6e23a8c635c"], timeout=timeout)
             return True
             
         elif cmd_type == "power_balanced":
             print("⚖️ Setting power profile: Balanced")
-            subprocess.run(["powercfg", "/setactive", "381b4222-f694-41f0-9685-ff5bb260df2e"])
+            subprocess.run(["powercfg", "/setactive", "381b4222-f694-41f0-9685-ff5bb260df2e"], timeout=timeout)
             return True
             
         elif cmd_type == "power_saver":
             print("🔋 Setting power profile: Power Saver")
-            subprocess.run(["powercfg", "/setactive", "a1841308-3541-4fab-bc81-f71556f20b4a"])
+            subprocess.run(["powercfg", "/setactive", "a1841308-3541-4fab-bc81-f71556f20b4a"], timeout=timeout)
             return True
             
         # Brightness control
@@ -89,7 +712,7 @@ def execute_command(command, params):
         elif cmd_type == "close_app":
             app = params.get("app", "")
             print(f"❌ Closing application: {app}")
-            os.system(f"taskkill /IM {app} /F")
+            subprocess.run(["taskkill", "/IM", app, "/F"], timeout=timeout)
             return True
             
         # Screenshot
@@ -114,42 +737,116 @@ def execute_command(command, params):
         print(f"❌ Error executing command: {e}")
         return False
 
-def check_for_commands():
-    """Check server for pending remote commands"""
-    try:
-        # Include authentication in request
-        headers = {
-            "X-Device-ID": DEVICE_ID,
-            "X-User-ID": USER_ID,
-            "Authorization": f"Bearer {DEVICE_TOKEN}"
-        }
-        response = requests.get(COMMAND_URL, headers=headers, timeout=5)
-        if response.status_code == 200:
-            data = response.json()
-            commands = data.get("commands", [])
-            
-            for cmd in commands:
-                cmd_id = cmd["id"]
-                command = cmd["command"]
-                params = cmd.get("params", {})
-                
-                print(f"\n🎮 Remote command received: {command}")
-                success = execute_command(command, params)
-                
-                # Acknowledge command execution
-                requests.post(f"{ACK_URL}/{cmd_id}", headers=headers, params={"success": success}, timeout=5)
-                
-    except Exception as e:
-        pass  # Silently fail if server is unreachable
+class CommandWorkerPool:
+    """Runs remote commands off the collection loop and reports results via a callback.
+
+    Each running command gets a dedicated thread, started as long as its
+    group (see COMMAND_GROUPS) is below its limit; otherwise it waits in
+    that group's queue. A hung command therefore never delays commands of
+    other groups. A watchdog, started when the command starts running,
+    reports it as failed once it exceeds its timeout and frees its group
+    slot, even if the call it is stuck in never returns. Results of recent
+    commands are kept, so a command redelivered by the server (e.g. after a
+    lost ack) is re-acked instead of executed twice.
+    """
+
+    def __init__(self, report, keep_results=256):
+        self.report = report  # report(command dict, success, duration, output)
+        self.keep_results = keep_results
+        self._lock = threading.Lock()
+        self._running = {}   # group -> number of commands running
+        self._waiting = {}   # group -> deque of commands
+        self._active = set() # ids queued or running
+        self._results = OrderedDict()  # id -> (success, duration, output), most recent last
+        self._closed = False
+
+    def submit(self, cmd):
+        """Queue a delivered command; returns immediately"""
+        cmd_id = cmd["id"]
+        with self._lock:
+            if self._closed or cmd_id in self._active:
+                return
+            if cmd_id in self._results:
+                success, duration, output = self._results[cmd_id]
+            else:
+                self._active.add(cmd_id)
+                group = COMMAND_GROUPS.get(cmd["command"].lower(), cmd["command"].lower())
+                if self._running.get(group, 0) < COMMAND_LIMITS.get(group, 1):
+                    self._start(group, cmd)
+                else:
+                    self._waiting.setdefault(group, deque()).append(cmd)
+                return
+        self.report(cmd, success, duration, output)
+
+    def _start(self, group, cmd):
+        # Called with the lock held
+        self._running[group] = self._running.get(group, 0) + 1
+        thread = threading.Thread(target=self._run, args=(group, cmd, threading.Event()), daemon=True,
+                                  name=f"command-{cmd['id']}")
+        thread.start()
+
+    def _run(self, group, cmd, finished):
+        if finished.is_set() or self._closed:
+            return
+        timeout = COMMAND_TIMEOUTS.get(cmd["command"].lower(), DEFAULT_COMMAND_TIMEOUT)
+        started = time.monotonic()
+        watchdog = threading.Timer(timeout, self._finish, (group, cmd, False, finished, started, f"timed out after {timeout}s"))
+        watchdog.daemon = True
+        watchdog.start()
+        success = execute_command(cmd["command"], cmd.get("params") or {}, timeout)
+        watchdog.cancel()
+        self._finish(group, cmd, success, finished, started)
+
+    def _finish(self, group, cmd, success, finished, started, reason=None):
+        with self._lock:
+            if finished.is_set():
+                return  # Already reported (by the watchdog or the command itself)
+            finished.set()
+            self._running[group] -= 1
+            self._active.discard(cmd["id"])
+            duration = time.monotonic() - started
+            self._results[cmd["id"]] = (success, duration, reason)
+            while len(self._results) > self.keep_results:
+                self._results.popitem(last=False)
+            waiting = self._waiting.get(group)
+            if waiting and not self._closed:
+                self._start(group, waiting.popleft())
+        if reason:
+            print(f"⚠️ Command {cmd['command']} {reason}")
+        self.report(cmd, success, duration, reason)
+
+    def shutdown(self):
+        """Stop starting commands; ones already running finish on their own threads"""
+        with self._lock:
+            self._closed = True
+            self._waiting.clear()
+
+def run_commands(commands, pool):
+    """Hand delivered remote commands to the worker pool; results are acked with a later upload"""
+    for cmd in commands:
+        print(f"\n🎮 Remote command received: {cmd['command']}")
+        pool.submit(cmd)
 
 def start_agent():
     print(f"Agent started. Sending to {API_URL}...")
+    cpu_sampler = CpuSampler()
+    scheduler = FixedRateScheduler(UPDATE_INTERVAL)
+    tiers = TieredCollector(COLLECTION_INTERVALS)
+    uploader = SampleUploader(session, spool=open_spool())
+    pool = CommandWorkerPool(lambda cmd, *result: uploader.ack(cmd["id"], *result))
+    
+    if PUSH_COMMANDS:
+        listener_session = create_session(DEVICE_ID, USER_ID, DEVICE_TOKEN)
+        CommandListener(listener_session, lambda commands: run_commands(commands, pool)).start()
 
     while True:
+        sample_time = scheduler.wait()
         try:
-            # 1. CPU Data (with details)
-            cpu_usage = psutil.cpu_percent(interval=1)
-            cpu_per_core = psutil.cpu_percent(interval=0, percpu=True)
+            # Static host facts (cached, not re-detected every tick)
+            static_facts = get_static_facts()
+
+            # 1. CPU Data (with details) - delta since the previous tick, no blocking
+            cpu_usage, cpu_per_core = cpu_sampler.sample()
             cpu_freq = psutil.cpu_freq()
             cpu_details = {
                 "usage": cpu_usage,
@@ -157,8 +854,8 @@ def start_agent():
                 "frequency_current": round(cpu_freq.current, 2) if cpu_freq else 0,
                 "frequency_min": round(cpu_freq.min, 2) if cpu_freq else 0,
                 "frequency_max": round(cpu_freq.max, 2) if cpu_freq else 0,
-                "core_count_physical": psutil.cpu_count(logical=False),
-                "core_count_logical": psutil.cpu_count(logical=True)
+                "core_count_physical": static_facts["core_count_physical"],
+                "core_count_logical": static_facts["core_count_logical"]
             }
 
             # 2. RAM Data (with details)
@@ -180,39 +877,12 @@ def start_agent():
                 "percent": swap.percent
             }
 
-            # 3. GPU Data (with details)
-            gpus = GPUtil.getGPUs()
-            gpu_usage = gpus[0].load * 100 if gpus else 0
-            gpu_details = []
-            if gpus:
-                for gpu in gpus:
-                    gpu_details.append({
-                        "id": gpu.id,
-                        "name": gpu.name,
-                        "load_percent": round(gpu.load * 100, 1),
-                        "memory_used_mb": round(gpu.memoryUsed, 2),
-                        "memory_total_mb": round(gpu.memoryTotal, 2),
-                        "memory_free_mb": round(gpu.memoryFree, 2),
-                        "memory_percent": round((gpu.memoryUsed / gpu.memoryTotal) * 100, 1),
-                        "temperature_c": gpu.temperature
-                    })
-
-            # 4. Disk Data (with details)
-            disk_info = {}
-            for partition in psutil.disk_partitions():
-                try:
-                    usage = psutil.disk_usage(partition.mountpoint)
-                    drive_letter = partition.device.replace(':\\', '')
-                    disk_info[drive_letter] = {
-                        "usage_percent": round(usage.percent, 1),
-                        "total_gb": round(usage.total / (1024**3), 2),
-                        "used_gb": round(usage.used / (1024**3), 2),
-                        "free_gb": round(usage.free / (1024**3), 2),
-                        "filesystem": partition.fstype,
-                        "mount_point": partition.mountpoint
-                    }
-                except PermissionError:
-                    continue
+            # 3. GPU Data (with details) - tiered, nvidia-smi is expensive
+            gpu_details = tiers.get("gpu", collect_gpus, sample_time)
+            gpu_usage = gpu_details[0]["load_percent"] if gpu_details else 0
+
+            # 4. Disk Data (with details) - tiered
+            disk_info = tiers.get("disks", collect_disks, sample_time)
             
             # Disk I/O statistics
             disk_io = psutil.disk_io_counters()
@@ -238,118 +908,39 @@ def start_agent():
                 "drop_out": net_io.dropout
             }
 
-            # 6. Battery Data (with details) - PRIMARY
-            battery = psutil.sensors_battery()
-            battery_details = None
-            if battery:
-                time_left = battery.secsleft
-                if time_left == psutil.POWER_TIME_UNLIMITED:
-                    time_left_str = "Charging/Plugged"
-                    time_left_minutes = None
-                elif time_left == psutil.POWER_TIME_UNKNOWN:
-                    time_left_str = "Unknown"
-                    time_left_minutes = None
-                else:
-                    time_left_minutes = round(time_left / 60, 1)
-                    time_left_str = f"{time_left_minutes} minutes"
-                
-                battery_details = {
-                    "percent": battery.percent,
-                    "plugged": battery.power_plugged,
-                    "time_left_minutes": time_left_minutes,
-                    "time_left_str": time_left_str
-                }
+            # 6. Battery Data (with details) - PRIMARY, tiered
+            battery_details = tiers.get("battery", collect_battery, sample_time)
 
             # 7. System Information (with details) - PRIMARY
-            boot_time = psutil.boot_time()
+            boot_time = static_facts["boot_time"]
             uptime_seconds = time.time() - boot_time
             uptime_hours = round(uptime_seconds / 3600, 1)
             
-            # Get CPU model name (proper marketing name)
-            cpu_model = None
-            
-            # Method 1: Try Windows Registry (most reliable)
-            if platform.system() == "Windows":
-                try:
-                    import winreg
-                    key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, 
-                                        r"HARDWARE\DESCRIPTION\System\CentralProcessor\0")
-                    cpu_model = winreg.QueryValueEx(key, "ProcessorNameString")[0].strip()
-                    winreg.CloseKey(key)
-                except:
-                    pass
-            
-            # Method 2: Try WMIC if registry failed
-            if not cpu_model:
-                try:
-                    import subprocess
-                    result = subprocess.run(['wmic', 'cpu', 'get', 'name'], 
-                                          capture_output=True, text=True, timeout=2, shell=True)
-                    lines = result.stdout.strip().split('\n')
-                    if len(lines) > 1:
-                        cpu_model = lines[1].strip()
-                except:
-                    pass
-            
-            # Method 3: Fallback to platform.processor()
-            if not cpu_model or "Family" in str(cpu_model) or "Model" in str(cpu_model):
-                cpu_model = platform.processor()
-            
-            # Final fallback
-            if not cpu_model or cpu_model.strip() == "":
-                cpu_model = f"{platform.machine()} Processor"
-            
-            # Get GPU model name
-            gpu_model = "No GPU detected"
-            if gpu_details:
-                gpu_model = gpu_details[0]["name"]
-            
             system_details = {
-                "os_name": platform.system(),  # PRIMARY
-                "os_version": platform.version(),
-                "os_release": platform.release(),
-                "hostname": platform.node(),
-                "architecture": platform.machine(),
-                "processor": platform.processor(),
-                "cpu_model": cpu_model,  # PRIMARY - CPU Model Name
-                "gpu_model": gpu_model,  # PRIMARY - GPU Model Name
-                "python_version": platform.python_version(),
+                "os_name": static_facts["os_name"],  # PRIMARY
+                "os_version": static_facts["os_version"],
+                "os_release": static_facts["os_release"],
+                "hostname": static_facts["hostname"],
+                "architecture": static_facts["architecture"],
+                "processor": static_facts["processor"],
+                "cpu_model": static_facts["cpu_model"],  # PRIMARY - CPU Model Name
+                "gpu_model": static_facts["gpu_model"],  # PRIMARY - GPU Model Name
+                "python_version": static_facts["python_version"],
                 "uptime_hours": uptime_hours,
                 "uptime_seconds": round(uptime_seconds),
-                "boot_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(boot_time))
+                "boot_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(boot_time)),
+                "tags": static_facts["tags"]
             }
 
-            # 8. Process Information (Top 5 CPU and Memory)
-            processes = []
-            for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
-                try:
-                    processes.append(proc.info)
-                except (psutil.NoSuchProcess, psutil.AccessDenied):
-                    pass
-            
-            top_cpu_processes = sorted(
-                [p for p in processes if p['cpu_percent'] is not None], 
-                key=lambda x: x['cpu_percent'], 
-                reverse=True
-            )[:5]
-            
-            top_memory_processes = sorted(
-                [p for p in processes if p['memory_percent'] is not None], 
-                key=lambda x: x['memory_percent'], 
-                reverse=True
-            )[:5]
-            
-            process_details = {
-                "top_cpu": top_cpu_processes,
-                "top_memory": top_memory_processes,
-                "total_processes": len(processes)
-            }
+            # 8. Process Information (Top 5 CPU and Memory) - tiered
+            process_details = tiers.get("processes", collect_processes, sample_time)
 
             # 9. Prepare Comprehensive Payload
             payload = {
                 # Authentication
                 "device_id": DEVICE_ID,
                 "user_id": USER_ID,
+                "timestamp": sample_time,
                 
                 # Simple values for backward compatibility
                 "cpu": cpu_usage,
@@ -370,15 +961,14 @@ def start_agent():
                 "processes": process_details
             }
 
-            # 10. Send to API with authentication headers
-            headers = {
-                "X-Device-ID": DEVICE_ID,
-                "X-User-ID": USER_ID,
-                "Authorization": f"Bearer {DEVICE_TOKEN}"
-            }
-            response = requests.post(API_URL, json=payload, headers=headers, timeout=10)
+            # 10. Send to API (auth headers live on the shared session)
+            response = uploader.add(payload)
 
-            if response.status_code == 200:
+            if response is None and uploader.backing_off():
+                print(f"… Server unreachable, buffered {len(uploader.buffer)} samples until the next retry")
+            elif response is None:
+                print(f"… Buffered sample ({len(uploader.buffer)}/{uploader.upload_every})")
+            elif response.status_code == 200:
                 print(f"✓ Sent Data:")
                 print(f"  OS: {system_details['os_name']} | Uptime: {uptime_hours}h")
                 if battery_details:
@@ -392,8 +982,8 @@ def start_agent():
             else:
                 print(f"✗ Server Error: {response.status_code}")
                 
-            # Check for remote commands
-            check_for_commands()
+            # Run remote commands delivered with the update response
+            run_commands(uploader.take_commands(), pool)
 
         except requests.exceptions.ConnectionError:
             print("✗ Cannot connect to API. Check internet connection.")
@@ -402,8 +992,5 @@ def start_agent():
         except Exception as e:
             print(f"✗ Error: {e}")
 
-        # Wait 2 seconds before next update
-        time.sleep(2)
-
 if __name__ == "__main__":
     start_agent()
\ No newline at end of file
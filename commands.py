@@ -0,0 +1,153 @@
+"""
+Per-device remote command queue with an id index, redelivery of unacked
+commands and bounded size.
+"""
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds a delivered command may stay unacked before it is delivered again
+VISIBILITY_TIMEOUT = 60
+# Seconds after queueing that a command is dropped if it was never acked
+COMMAND_TTL = 600
+# Deliveries before an unacked command is given up on
+MAX_DELIVERIES = 3
+# Commands kept per device; the oldest is dropped beyond this
+MAX_QUEUED = 100
+
+class CommandIdGenerator:
+    """Snowflake-style command ids: milliseconds since EPOCH_MS, worker id, sequence.
+
+    Ids are unique and strictly increasing within a process, and distinct
+    across up to 16 concurrently running workers. They stay below 2**53 so
+    JSON clients that use doubles (Dart on the web, JavaScript) read them
+    exactly.
+    """
+
+    EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+    WORKER_BITS = 4
+    SEQUENCE_BITS = 8
+
+    def __init__(self, worker_id=None):
+        if worker_id is None:
+            worker_id = int(os.getenv("COMMAND_WORKER_ID") or random.randrange(1 << self.WORKER_BITS))
+        self.worker_id = worker_id % (1 << self.WORKER_BITS)
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now_ms = int(time.time() * 1000) - self.EPOCH_MS
+            if now_ms > self._last_ms:
+                self._last_ms, self._sequence = now_ms, 0
+            else:
+                # Same millisecond or the clock went back: keep counting from the last one
+                self._sequence += 1
+                if self._sequence >> self.SEQUENCE_BITS:
+                    self._last_ms, self._sequence = self._last_ms + 1, 0
+            return ((self._last_ms << (self.WORKER_BITS + self.SEQUENCE_BITS))
+                    | (self.worker_id << self.SEQUENCE_BITS) | self._sequence)
+
+class DeviceCommandQueue:
+    """Commands for one device.
+
+    commands indexes every live command by id in queue order. pending holds
+    ids not yet delivered (FIFO) and in_flight the delivered ones by
+    redelivery deadline. All deadlines share one timeout, so both expiry
+    checks only look at the front of their ordered dicts.
+    """
+
+    def __init__(self, visibility_timeout=VISIBILITY_TIMEOUT, ttl=COMMAND_TTL,
+                 max_deliveries=MAX_DELIVERIES, max_queued=MAX_QUEUED):
+        self.visibility_timeout = visibility_timeout
+        self.ttl = ttl
+        self.max_deliveries = max_deliveries
+        self.max_queued = max_queued
+        self.commands = OrderedDict()  # id -> command dict
+        self.pending = OrderedDict()   # id -> None
+        self.in_flight = OrderedDict() # id -> redelivery deadline (monotonic)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(self.commands.values())
+
+    def get(self, command_id):
+        return self.commands.get(command_id)
+
+    def _remove(self, command_id):
+        self.pending.pop(command_id, None)
+        self.in_flight.pop(command_id, None)
+        return self.commands.pop(command_id, None)
+
+    def expire(self):
+        """Drop commands past their TTL and requeue deliveries that were never acked.
+
+        Runs on every take(); call it directly for devices that may never poll.
+        """
+        cutoff = time.time() - self.ttl
+        while self.commands:
+            command_id, command = next(iter(self.commands.items()))
+            if command["timestamp"] >= cutoff:
+                break
+            self._remove(command_id)
+            print(f"[API] Command {command_id} ({command['command']}) expired unacknowledged")
+
+        now = time.monotonic()
+        while self.in_flight:
+            command_id, deadline = next(iter(self.in_flight.items()))
+            if deadline > now:
+                break
+            del self.in_flight[command_id]
+            command = self.commands[command_id]
+            if command["deliveries"] >= self.max_deliveries:
+                self._remove(command_id)
+                print(f"[API] Command {command_id} ({command['command']}) dropped after {command['deliveries']} deliveries")
+                continue
+            command["status"] = "pending"
+            self.pending[command_id] = None
+
+    def enqueue(self, command):
+        """Queue a command dict (needs id, command and timestamp)"""
+        command.setdefault("status", "pending")
+        command.setdefault("deliveries", 0)
+        self.commands[command["id"]] = command
+        self.pending[command["id"]] = None
+        while len(self.commands) > self.max_queued:
+            self._remove(next(iter(self.commands)))
+
+    def take(self):
+        """Return the commands due for delivery and mark them in flight"""
+        self.expire()
+        if not self.pending:
+            return []
+        deadline = time.monotonic() + self.visibility_timeout
+        delivered = []
+        for command_id in self.pending:
+            command = self.commands[command_id]
+            command["status"] = "sent"
+            command["deliveries"] += 1
+            self.in_flight[command_id] = deadline
+            delivered.append(command)
+        self.pending.clear()
+        return delivered
+
+    def ack(self, command_id):
+        """Remove an executed command; returns it, or None if unknown or already expired"""
+        return self._remove(command_id)
+
+    @classmethod
+    def from_list(cls, commands, **options):
+        """Rebuild from persisted command dicts; delivered ones get a fresh visibility timeout"""
+        queue = cls(**options)
+        deadline = time.monotonic() + queue.visibility_timeout
+        for command in commands:
+            queue.enqueue(command)
+            if command["status"] == "sent":
+                del queue.pending[command["id"]]
+                queue.in_flight[command["id"]] = deadline
+        return queue
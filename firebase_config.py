@@ -10,6 +10,15 @@
 import firebase_admin
 from firebase_admin import credentials, auth, firestore
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# The Admin SDK is blocking; async code runs it through this bounded pool
+FIREBASE_MAX_WORKERS = int(os.getenv("FIREBASE_MAX_WORKERS") or 16)
+FIREBASE_MAX_IN_FLIGHT = FIREBASE_MAX_WORKERS * 4  # Running plus queued calls
+FIREBASE_TIMEOUT = float(os.getenv("FIREBASE_TIMEOUT") or 5)
+_executor = ThreadPoolExecutor(max_workers=FIREBASE_MAX_WORKERS, thread_name_prefix="firebase")
+_in_flight = asyncio.Semaphore(FIREBASE_MAX_IN_FLIGHT)
 
 # Initialize Firebase Admin SDK
 def initialize_firebase():
@@ -50,11 +59,15 @@ def initialize_firebase():
             return False
 
 def verify_token(id_token):
-    """Verify Firebase ID token and return user info"""
+    """Verify Firebase ID token and return user info, or None if the token is invalid.
+
+    Transport errors (e.g. fetching Google's public certificates) propagate,
+    so callers can tell them apart from a rejected token.
+    """
     try:
         decoded_token = auth.verify_id_token(id_token)
         return decoded_token
-    except Exception as e:
+    except (ValueError, auth.InvalidIdTokenError, auth.UserDisabledError) as e:
         print(f"❌ Token verification failed: {e}")
         return None
 
@@ -62,5 +75,41 @@ def get_firestore_db():
     """Get Firestore database instance"""
     return firestore.client()
 
+def device_exists(user_id, device_id):
+    """Check whether a device is registered for the user in Firestore"""
+    db = get_firestore_db()
+    return db.collection('users').document(user_id).collection('devices').document(device_id).get().exists
+
+def delete_device(user_id, device_id):
+    """Remove a device's registration from Firestore"""
+    db = get_firestore_db()
+    db.collection('users').document(user_id).collection('devices').document(device_id).delete()
+
+async def run_firebase(func, *args, timeout=FIREBASE_TIMEOUT):
+    """Run a blocking Firebase call without stalling the event loop.
+
+    At most FIREBASE_MAX_IN_FLIGHT calls are queued or running at once, and
+    the caller gets asyncio.TimeoutError after `timeout` seconds (including
+    time spent waiting for a slot). A call that times out keeps its slot
+    until its thread actually finishes, so stuck calls can't pile up.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    await asyncio.wait_for(_in_flight.acquire(), timeout)
+    try:
+        future = _executor.submit(func, *args)
+    except BaseException:
+        _in_flight.release()
+        raise
+    def release(_):
+        # Runs on the worker thread (or here, if cancelled before starting)
+        try:
+            loop.call_soon_threadsafe(_in_flight.release)
+        except RuntimeError:
+            pass  # Event loop already closed
+
+    future.add_done_callback(release)
+    return await asyncio.wait_for(asyncio.wrap_future(future), max(deadline - loop.time(), 0))
+
 # Initialize on import
 initialize_firebase()
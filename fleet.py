@@ -0,0 +1,128 @@
+"""
+Per-user fleet aggregates maintained incrementally as devices report, so a
+fleet summary is a constant-time read instead of a scan over every snapshot.
+"""
+import math
+import time
+from bisect import insort, bisect_left
+from collections import OrderedDict
+
+# A device counts as online while its last update is at most this old (seconds)
+ONLINE_WINDOW = 60
+
+def _remove_sorted(values, value):
+    index = bisect_left(values, value)
+    if index < len(values) and values[index] == value:
+        del values[index]
+
+def _percentile(values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)] if values else None
+
+class UserFleet:
+    """Running aggregates over one user's online devices.
+
+    Devices are kept in update order, so the stalest ones are evicted from
+    the front without scanning. Sums give averages; sorted lists give max,
+    percentiles and the lowest disk free.
+    """
+
+    def __init__(self):
+        self.devices = OrderedDict()  # device_id -> (last_seen, cpu, ram, disks, on_battery)
+        self.cpu = []
+        self.ram = []
+        self.disk_free = []  # (percent free, device_id, drive)
+        self.cpu_sum = 0.0
+        self.ram_sum = 0.0
+        self.on_battery = 0
+
+    def _add(self, entry):
+        _, cpu, ram, disks, on_battery = entry
+        insort(self.cpu, cpu)
+        insort(self.ram, ram)
+        for disk in disks:
+            insort(self.disk_free, disk)
+        self.cpu_sum += cpu
+        self.ram_sum += ram
+        self.on_battery += on_battery
+
+    def _discard(self, entry):
+        _, cpu, ram, disks, on_battery = entry
+        _remove_sorted(self.cpu, cpu)
+        _remove_sorted(self.ram, ram)
+        for disk in disks:
+            _remove_sorted(self.disk_free, disk)
+        self.cpu_sum -= cpu
+        self.ram_sum -= ram
+        self.on_battery -= on_battery
+
+    def update(self, device_id, entry):
+        self.remove(device_id)
+        self.devices[device_id] = entry
+        self._add(entry)
+
+    def remove(self, device_id):
+        entry = self.devices.pop(device_id, None)
+        if entry:
+            self._discard(entry)
+
+    def expire(self, cutoff):
+        while self.devices:
+            device_id, entry = next(iter(self.devices.items()))
+            if entry[0] >= cutoff:
+                break
+            self.remove(device_id)
+
+    def _stats(self, values, total):
+        if not values:
+            return None
+        return {
+            "avg": round(total / len(values), 1),
+            "max": round(values[-1], 1),
+            "p95": round(_percentile(values, 95), 1)
+        }
+
+    def summary(self):
+        lowest = None
+        if self.disk_free:
+            free, device_id, drive = self.disk_free[0]
+            lowest = {"device_id": device_id, "drive": drive, "free_percent": round(free, 1)}
+        return {
+            "online": len(self.devices),
+            "cpu": self._stats(self.cpu, self.cpu_sum),
+            "ram": self._stats(self.ram, self.ram_sum),
+            "lowest_disk_free": lowest,
+            "on_battery": self.on_battery
+        }
+
+class FleetAggregates:
+    """Fleet summaries for every user, keyed by user_id"""
+
+    def __init__(self, online_window=ONLINE_WINDOW):
+        self.online_window = online_window
+        self._fleets = {}  # Format: {user_id: UserFleet}
+
+    def update(self, user_id, device_id, snapshot):
+        """Replace the device's contribution with its latest snapshot"""
+        battery = snapshot.get("battery") or {}
+        disks = tuple(
+            (100.0 - percent, device_id, drive) for drive, percent in (snapshot.get("disk") or {}).items()
+        )
+        entry = (
+            time.time(),
+            float(snapshot.get("cpu") or 0),
+            float(snapshot.get("ram") or 0),
+            disks,
+            1 if battery and battery.get("plugged") is False else 0
+        )
+        self._fleets.setdefault(user_id, UserFleet()).update(device_id, entry)
+
+    def remove(self, user_id, device_id):
+        fleet = self._fleets.get(user_id)
+        if fleet:
+            fleet.remove(device_id)
+
+    def summary(self, user_id):
+        fleet = self._fleets.get(user_id) or UserFleet()
+        fleet.expire(time.time() - self.online_window)
+        return fleet.summary()
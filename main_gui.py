@@ -23,7 +23,12 @@ old_stdout = sys.stdout
 sys.stdout = StringIO()
 
 # Import functions from existing files without modification
-from agent import execute_command, check_for_commands
+from agent import (
+    create_session,
+    CpuSampler, FixedRateScheduler, TieredCollector, SampleUploader, CommandListener, CommandWorkerPool, open_spool,
+    UPDATE_INTERVAL, COLLECTION_INTERVALS, PUSH_COMMANDS, get_static_facts,
+    collect_gpus, collect_disks, collect_battery, collect_processes
+)
 
 sys.stdout = old_stdout
 
@@ -857,20 +862,34 @@ class SystemMonitorApp(ctk.CTk):
     
     def agent_loop(self):
         """Background thread running the agent - EXACT COPY of agent.py logic"""
-        API_URL = "https://system-monitor-silk.vercel.app/api/update"
-        COMMAND_URL = "https://system-monitor-silk.vercel.app/api/commands"
-        ACK_URL = "https://system-monitor-silk.vercel.app/api/command/ack"
+        cpu_sampler = CpuSampler()
+        scheduler = FixedRateScheduler(UPDATE_INTERVAL)
+        tiers = TieredCollector(COLLECTION_INTERVALS)
+        
+        # Get credentials from environment
+        device_id = os.getenv("DEVICE_ID")
+        user_id = os.getenv("USER_ID")
+        device_token = os.getenv("DEVICE_TOKEN")
+        session = create_session(device_id, user_id, device_token)
+        uploader = SampleUploader(session, spool=open_spool())
+        pool = CommandWorkerPool(lambda cmd, *result: self.report_command_result(cmd, uploader, *result))
+        
+        listener = None
+        if PUSH_COMMANDS:
+            listener = CommandListener(
+                create_session(device_id, user_id, device_token),
+                lambda commands: self.run_remote_commands(commands, pool)
+            )
+            listener.start()
         
         while self.agent_running:
+            sample_time = scheduler.wait()
             try:
-                # Get credentials from environment
-                device_id = os.getenv("DEVICE_ID")
-                user_id = os.getenv("USER_ID")
-                device_token = os.getenv("DEVICE_TOKEN")
-                
-                # 1. CPU Data (with details)
-                cpu_usage = psutil.cpu_percent(interval=1)
-                cpu_per_core = psutil.cpu_percent(interval=0, percpu=True)
+                # Static host facts (cached, not re-detected every tick)
+                static_facts = get_static_facts()
+
+                # 1. CPU Data (with details) - delta since the previous tick, no blocking
+                cpu_usage, cpu_per_core = cpu_sampler.sample()
                 cpu_freq = psutil.cpu_freq()
                 cpu_details = {
                     "usage": cpu_usage,
@@ -878,8 +897,8 @@ class SystemMonitorApp(ctk.CTk):
                     "frequency_current": round(cpu_freq.current, 2) if cpu_freq else 0,
                     "frequency_min": round(cpu_freq.min, 2) if cpu_freq else 0,
                     "frequency_max": round(cpu_freq.max, 2) if cpu_freq else 0,
-                    "core_count_physical": psutil.cpu_count(logical=False),
-                    "core_count_logical": psutil.cpu_count(logical=True)
+                    "core_count_physical": static_facts["core_count_physical"],
+                    "core_count_logical": static_facts["core_count_logical"]
                 }
 
                 # 2. RAM Data (with details)
@@ -901,39 +920,12 @@ class SystemMonitorApp(ctk.CTk):
                     "percent": swap.percent
                 }
 
-                # 3. GPU Data (with details)
-                gpus = GPUtil.getGPUs()
-                gpu_usage = gpus[0].load * 100 if gpus else 0
-                gpu_details = []
-                if gpus:
-                    for gpu in gpus:
-                        gpu_details.append({
-                            "id": gpu.id,
-                            "name": gpu.name,
-                            "load_percent": round(gpu.load * 100, 1),
-                            "memory_used_mb": round(gpu.memoryUsed, 2),
-                            "memory_total_mb": round(gpu.memoryTotal, 2),
-                            "memory_free_mb": round(gpu.memoryFree, 2),
-                            "memory_percent": round((gpu.memoryUsed / gpu.memoryTotal) * 100, 1),
-                            "temperature_c": gpu.temperature
-                        })
+                # 3. GPU Data (with details) - tiered, nvidia-smi is expensive
+                gpu_details = tiers.get("gpu", collect_gpus, sample_time)
+                gpu_usage = gpu_details[0]["load_percent"] if gpu_details else 0
 
-                # 4. Disk Data (with details)
-                disk_info = {}
-                for partition in psutil.disk_partitions():
-                    try:
-                        usage = psutil.disk_usage(partition.mountpoint)
-                        drive_letter = partition.device.replace(':\\', '')
-                        disk_info[drive_letter] = {
-                            "usage_percent": round(usage.percent, 1),
-                            "total_gb": round(usage.total / (1024**3), 2),
-                            "used_gb": round(usage.used / (1024**3), 2),
-                            "free_gb": round(usage.free / (1024**3), 2),
-                            "filesystem": partition.fstype,
-                            "mount_point": partition.mountpoint
-                        }
-                    except PermissionError:
-                        continue
+                # 4. Disk Data (with details) - tiered
+                disk_info = tiers.get("disks", collect_disks, sample_time)
                 
                 # Disk I/O statistics
                 disk_io = psutil.disk_io_counters()
@@ -959,113 +951,39 @@ class SystemMonitorApp(ctk.CTk):
                     "drop_out": net_io.dropout
                 }
 
-                # 6. Battery Data (with details)
-                battery = psutil.sensors_battery()
-                battery_details = None
-                if battery:
-                    time_left = battery.secsleft
-                    if time_left == psutil.POWER_TIME_UNLIMITED:
-                        time_left_str = "Charging/Plugged"
-                        time_left_minutes = None
-                    elif time_left == psutil.POWER_TIME_UNKNOWN:
-                        time_left_str = "Unknown"
-                        time_left_minutes = None
-                    else:
-                        time_left_minutes = round(time_left / 60, 1)
-                        time_left_str = f"{time_left_minutes} minutes"
-                    
-                    battery_details = {
-                        "percent": battery.percent,
-                        "plugged": battery.power_plugged,
-                        "time_left_minutes": time_left_minutes,
-                        "time_left_str": time_left_str
-                    }
+                # 6. Battery Data (with details) - tiered
+                battery_details = tiers.get("battery", collect_battery, sample_time)
 
                 # 7. System Information (with details)
-                boot_time = psutil.boot_time()
+                boot_time = static_facts["boot_time"]
                 uptime_seconds = time.time() - boot_time
                 uptime_hours = round(uptime_seconds / 3600, 1)
                 
-                # Get CPU model name
-                cpu_model = None
-                if platform.system() == "Windows":
-                    try:
-                        import winreg
-                        key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, 
-                                            r"HARDWARE\DESCRIPTION\System\CentralProcessor\0")
-                        cpu_model = winreg.QueryValueEx(key, "ProcessorNameString")[0].strip()
-                        winreg.CloseKey(key)
-                    except:
-                        pass
-                
-                if not cpu_model:
-                    try:
-                        import subprocess
-                        result = subprocess.run(['wmic', 'cpu', 'get', 'name'], 
-                                              capture_output=True, text=True, timeout=2, shell=True)
-                        lines = result.stdout.strip().split('\n')
-                        if len(lines) > 1:
-                            cpu_model = lines[1].strip()
-                    except:
-                        pass
-                
-                if not cpu_model or "Family" in str(cpu_model) or "Model" in str(cpu_model):
-                    cpu_model = platform.processor()
-                
-                if not cpu_model or cpu_model.strip() == "":
-                    cpu_model = f"{platform.machine()} Processor"
-                
-                # Get GPU model name
-                gpu_model = "No GPU detected"
-                if gpu_details:
-                    gpu_model = gpu_details[0]["name"]
-                
                 system_details = {
-                    "os_name": platform.system(),
-                    "os_version": platform.version(),
-                    "os_release": platform.release(),
-                    "hostname": platform.node(),
-                    "architecture": platform.machine(),
-                    "processor": platform.processor(),
-                    "cpu_model": cpu_model,
-                    "gpu_model": gpu_model,
-                    "python_version": platform.python_version(),
+                    "os_name": static_facts["os_name"],
+                    "os_version": static_facts["os_version"],
+                    "os_release": static_facts["os_release"],
+                    "hostname": static_facts["hostname"],
+                    "architecture": static_facts["architecture"],
+                    "processor": static_facts["processor"],
+                    "cpu_model": static_facts["cpu_model"],
+                    "gpu_model": static_facts["gpu_model"],
+                    "python_version": static_facts["python_version"],
                     "uptime_hours": uptime_hours,
                     "uptime_seconds": round(uptime_seconds),
-                    "boot_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(boot_time))
+                    "boot_time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(boot_time)),
+                    "tags": static_facts["tags"]
                 }
 
-                # 8. Process Information (Top 5 CPU and Memory)
-                processes = []
-                for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
-                    try:
-                        processes.append(proc.info)
-                    except (psutil.NoSuchProcess, psutil.AccessDenied):
-                        pass
-                
-                top_cpu_processes = sorted(
-                    [p for p in processes if p['cpu_percent'] is not None], 
-                    key=lambda x: x['cpu_percent'], 
-                    reverse=True
-                )[:5]
-                
-                top_memory_processes = sorted(
-                    [p for p in processes if p['memory_percent'] is not None], 
-                    key=lambda x: x['memory_percent'], 
-                    reverse=True
-                )[:5]
-                
-                process_details = {
-                    "top_cpu": top_cpu_processes,
-                    "top_memory": top_memory_processes,
-                    "total_processes": len(processes)
-                }
+                # 8. Process Information (Top 5 CPU and Memory) - tiered
+                process_details = tiers.get("processes", collect_processes, sample_time)
 
                 # 9. Prepare Comprehensive Payload (EXACT same as agent.py)
                 payload = {
                     # Authentication
                     "device_id": device_id,
                     "user_id": user_id,
+                    "timestamp": sample_time,
                     
                     # Simple values for backward compatibility
                     "cpu": cpu_usage,
@@ -1086,55 +1004,20 @@ class SystemMonitorApp(ctk.CTk):
                     "processes": process_details
                 }
 
-                # 10. Send to API with authentication headers
-                headers = {
-                    "X-Device-ID": device_id,
-                    "X-User-ID": user_id,
-                    "Authorization": f"Bearer {device_token}"
-                }
-                response = requests.post(API_URL, json=payload, headers=headers, timeout=10)
+                # 10. Send to API (auth headers live on the session)
+                response = uploader.add(payload)
                 
-                if response.status_code == 200:
+                if response is None:
+                    pass  # Buffered until the next batch upload
+                elif response.status_code == 200:
                     print(f"✓ Data sent - CPU: {cpu_usage}% | RAM: {ram_details['usage_percent']}%")
                     self.update_status(True)
                 else:
                     print(f"✗ Server Error: {response.status_code}")
                     self.update_status(False)
                 
-                # Check for remote commands
-                try:
-                    cmd_headers = {
-                        "X-Device-ID": device_id,
-                        "X-User-ID": user_id,
-                        "Authorization": f"Bearer {device_token}"
-                    }
-                    cmd_response = requests.get(COMMAND_URL, headers=cmd_headers, timeout=5)
-                    if cmd_response.status_code == 200:
-                        cmd_data = cmd_response.json()
-                        commands = cmd_data.get("commands", [])
-                        
-                        for cmd in commands:
-                            cmd_id = cmd["id"]
-                            command = cmd["command"]
-                            params = cmd.get("params", {})
-                            
-                            # Log to GUI
-                            self.log_command(f"📱 Remote command: {command}")
-                            
-                            print(f"🎮 Remote command: {command}")
-                            success = execute_command(command, params)
-                            
-                            # Log result
-                            if success:
-                                self.log_command(f"✅ Command executed: {command}")
-                            else:
-                                self.log_command(f"❌ Command failed: {command}")
-                            
-                            # Acknowledge command execution
-                            requests.post(f"{ACK_URL}/{cmd_id}", headers=cmd_headers, 
-                                        params={"success": success}, timeout=5)
-                except:
-                    pass
+                # Run remote commands delivered with the update response
+                self.run_remote_commands(uploader.take_commands(), pool)
                 
             except requests.exceptions.ConnectionError:
                 print("✗ Cannot connect to API")
@@ -1145,8 +1028,26 @@ class SystemMonitorApp(ctk.CTk):
             except Exception as e:
                 print(f"Agent error: {e}")
                 self.update_status(False)
-            
-            time.sleep(2)
+        
+        if listener:
+            listener.stop()
+        pool.shutdown()
+    
+    def run_remote_commands(self, commands, pool):
+        """Log remote commands and hand them to the worker pool"""
+        for cmd in commands:
+            # Log to GUI
+            self.log_command(f"📱 Remote command: {cmd['command']}")
+            print(f"🎮 Remote command: {cmd['command']}")
+            pool.submit(cmd)
+    
+    def report_command_result(self, cmd, uploader, success, duration, output):
+        """Log a finished command; the ack goes out with the next update"""
+        if success:
+            self.log_command(f"✅ Command executed: {cmd['command']}")
+        else:
+            self.log_command(f"❌ Command failed: {cmd['command']}")
+        uploader.ack(cmd["id"], success, duration, output)
     
     def update_status(self, connected):
         """Update connection status indicator with badge styling"""
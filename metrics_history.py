@@ -0,0 +1,399 @@
+"""
+In-process time-series history for device metrics.
+Each (user, device, metric) series is a set of fixed-size rings of compact
+arrays - raw samples plus incrementally maintained rollup tiers - so memory
+stays bounded no matter how long the server runs.
+"""
+import struct
+import sys
+import time
+from array import array
+
+# Raw samples kept per series (1 hour at the agent's default 2s interval)
+RAW_CAPACITY = 1800
+
+# Rollup tiers as (bucket width in seconds, buckets kept):
+# 1-minute buckets for a day, 15-minute buckets for a month
+ROLLUP_TIERS = [(60, 1440), (900, 2880)]
+
+# Assumed raw sample spacing when deciding whether the raw ring covers a range
+RAW_RESOLUTION = 2
+
+# Persisted history is split into chunks covering this many raw intervals or
+# rollup buckets, so a save rewrites only a small recent slice of each ring
+CHUNK_ROWS = 32
+
+# Columnar export stream: EXPORT_MAGIC, then one chunk per series. A chunk is
+# EXPORT_CHUNK (device id length, metric length, rows, resolution, columns),
+# the UTF-8 device id and metric, then per column a 1-byte name length, the
+# name, a 1-byte array typecode ("d" float64 / "f" float32) and the
+# little-endian values.
+EXPORT_MAGIC = b"SMX1"
+EXPORT_CHUNK = struct.Struct("<HHIfB")
+
+def snapshot_metrics(snapshot):
+    """Flatten a device snapshot into the numeric metrics kept in history"""
+    metrics = {
+        "cpu": snapshot.get("cpu"),
+        "ram": snapshot.get("ram"),
+        "gpu": snapshot.get("gpu")
+    }
+    swap = snapshot.get("swap_details") or {}
+    metrics["swap"] = swap.get("percent")
+    battery = snapshot.get("battery") or {}
+    metrics["battery"] = battery.get("percent")
+    network = snapshot.get("network") or {}
+    metrics["net_sent_mb"] = network.get("bytes_sent_mb")
+    metrics["net_recv_mb"] = network.get("bytes_recv_mb")
+    disk_io = snapshot.get("disk_io") or {}
+    metrics["disk_read_mb"] = disk_io.get("read_mb")
+    metrics["disk_write_mb"] = disk_io.get("write_mb")
+    for drive, percent in (snapshot.get("disk") or {}).items():
+        metrics[f"disk:{drive}"] = percent
+    return {name: float(value) for name, value in metrics.items() if value is not None}
+
+def encode_export_chunk(device_id, metric, resolution, columns):
+    """Encode one series' column arrays in the export chunk layout"""
+    device = device_id.encode("utf-8")
+    name = metric.encode("utf-8")
+    rows = len(columns["timestamps"])
+    parts = [EXPORT_CHUNK.pack(len(device), len(name), rows, resolution, len(columns)), device, name]
+    for column_name, column in columns.items():
+        if sys.byteorder == "big":
+            column.byteswap()
+        encoded = column_name.encode("utf-8")
+        parts += [bytes([len(encoded)]), encoded, column.typecode.encode("ascii"), column.tobytes()]
+    return b"".join(parts)
+
+class _Ring:
+    """Ring buffer bookkeeping over a timestamp column (arrays grow up to capacity)"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array("d")
+        self.start = 0
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _index(self, i):
+        return (self.start + i) % self.capacity
+
+    def last_timestamp(self):
+        return self.timestamps[self._index(len(self) - 1)] if len(self) else None
+
+    def _slot(self):
+        """Slot for a new entry: grow while below capacity, else overwrite the oldest"""
+        if len(self) < self.capacity:
+            return None
+        index = self.start
+        self.start = (self.start + 1) % self.capacity
+        return index
+
+    def columns(self):
+        return [self.timestamps]
+
+    def _bisect(self, timestamp):
+        """First logical position whose timestamp is >= `timestamp`"""
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[self._index(mid)] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _range_indexes(self, start, end):
+        first = self._bisect(start) if start is not None else 0
+        last = self._bisect(end + 1e-9) if end is not None else len(self)
+        return [self._index(i) for i in range(first, last)]
+
+    def _range_columns(self, start, end):
+        """Copy every column for start <= t <= end into new arrays (at most two slices each)"""
+        first = self._bisect(start) if start is not None else 0
+        last = self._bisect(end + 1e-9) if end is not None else len(self)
+        return self._slice_columns(first, last)
+
+    def _slice_columns(self, first, last):
+        a, b = self._index(first), self._index(first) + (last - first)
+        if b <= len(self):
+            return [column[a:b] for column in self.columns()]
+        return [column[a:] + column[:b - len(self)] for column in self.columns()]
+
+    def dump_chunks(self, since, span):
+        """(chunk start, bytes) for every span-aligned chunk with rows at or after `since`.
+
+        A chunk's bytes are its rows' columns concatenated, as read back by
+        load_chunk(). Empty chunks are skipped.
+        """
+        first = self._bisect(since)
+        while first < len(self):
+            timestamp = self.timestamps[self._index(first)]
+            start = timestamp - timestamp % span
+            last = self._bisect(start + span)
+            yield start, b"".join(column.tobytes() for column in self._slice_columns(first, last))
+            first = last
+
+    def load_chunk(self, data):
+        """Append a chunk from dump_chunks() to a ring being restored, oldest chunk first.
+
+        Rows beyond capacity push out the oldest ones; raises ValueError if
+        the data does not match this ring's columns.
+        """
+        columns = self.columns()
+        count, extra = divmod(len(data), sum(column.itemsize for column in columns))
+        if extra or self.start:
+            raise ValueError("Chunk does not match ring layout")
+        if count and len(self) and array("d", data[:8])[0] <= self.last_timestamp():
+            raise ValueError("Chunk overlaps restored rows")
+        offset = 0
+        for column in columns:
+            column.frombytes(data[offset:offset + count * column.itemsize])
+            offset += count * column.itemsize
+        excess = len(self) - self.capacity
+        if excess > 0:
+            for column in columns:
+                del column[:excess]
+
+class MetricRing(_Ring):
+    """Fixed-capacity ring of raw samples: float64 timestamps and float32 values"""
+
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.values = array("f")
+
+    def columns(self):
+        return [self.timestamps, self.values]
+
+    def append(self, timestamp, value):
+        """Add a sample; returns False for samples not newer than the last one (replays)"""
+        if len(self) and timestamp <= self.last_timestamp():
+            return False
+        index = self._slot()
+        if index is None:
+            self.timestamps.append(timestamp)
+            self.values.append(value)
+        else:
+            self.timestamps[index] = timestamp
+            self.values[index] = value
+        return True
+
+    def export(self, start=None, end=None):
+        """Column arrays for start <= t <= end, oldest first"""
+        timestamps, values = self._range_columns(start, end)
+        return {"timestamps": timestamps, "values": values}
+
+    def range(self, start=None, end=None):
+        """Return {"timestamps", "values"} for start <= t <= end, oldest first"""
+        indexes = self._range_indexes(start, end)
+        return {
+            "timestamps": [self.timestamps[i] for i in indexes],
+            "values": [round(self.values[i], 2) for i in indexes]
+        }
+
+class RollupRing(_Ring):
+    """Fixed-capacity ring of time buckets holding min/max/avg/last, updated per sample"""
+
+    def __init__(self, width, capacity):
+        super().__init__(capacity)
+        self.width = width
+        self.mins = array("f")
+        self.maxs = array("f")
+        self.sums = array("d")
+        self.counts = array("I")
+        self.lasts = array("f")
+
+    def columns(self):
+        return [self.timestamps, self.mins, self.maxs, self.sums, self.counts, self.lasts]
+
+    def add(self, timestamp, value):
+        bucket = timestamp - timestamp % self.width
+        if len(self) and bucket == self.last_timestamp():
+            i = self._index(len(self) - 1)
+            self.mins[i] = min(self.mins[i], value)
+            self.maxs[i] = max(self.maxs[i], value)
+            self.sums[i] += value
+            self.counts[i] += 1
+            self.lasts[i] = value
+            return
+        if len(self) and bucket < self.last_timestamp():
+            return
+        index = self._slot()
+        if index is None:
+            self.timestamps.append(bucket)
+            self.mins.append(value)
+            self.maxs.append(value)
+            self.sums.append(value)
+            self.counts.append(1)
+            self.lasts.append(value)
+        else:
+            self.timestamps[index] = bucket
+            self.mins[index] = value
+            self.maxs[index] = value
+            self.sums[index] = value
+            self.counts[index] = 1
+            self.lasts[index] = value
+
+    def export(self, start=None, end=None):
+        """Column arrays for the buckets in range, with the bucket average as values"""
+        start = start - start % self.width if start is not None else None
+        timestamps, mins, maxs, sums, counts, lasts = self._range_columns(start, end)
+        averages = array("f", [total / count for total, count in zip(sums, counts)])
+        return {"timestamps": timestamps, "values": averages, "min": mins, "max": maxs, "last": lasts}
+
+    def range(self, start=None, end=None):
+        """Return bucket start times with avg ("values"), min, max and last, oldest first"""
+        # Include the bucket that contains `start`
+        indexes = self._range_indexes(start - start % self.width if start is not None else None, end)
+        return {
+            "timestamps": [self.timestamps[i] for i in indexes],
+            "values": [round(self.sums[i] / self.counts[i], 2) for i in indexes],
+            "min": [round(self.mins[i], 2) for i in indexes],
+            "max": [round(self.maxs[i], 2) for i in indexes],
+            "last": [round(self.lasts[i], 2) for i in indexes]
+        }
+
+class MetricSeries:
+    """Raw ring plus its rollup tiers for one metric"""
+
+    def __init__(self, capacity=RAW_CAPACITY, tiers=ROLLUP_TIERS):
+        self.raw = MetricRing(capacity)
+        self.rollups = [RollupRing(width, buckets) for width, buckets in tiers]
+
+    def append(self, timestamp, value):
+        """Add a sample to the raw ring and every tier; returns False for replays"""
+        if not self.raw.append(timestamp, value):
+            return False
+        for rollup in self.rollups:
+            rollup.add(timestamp, value)
+        return True
+
+    def rings(self):
+        """(width, ring) for the raw ring (width 0) and each rollup tier"""
+        return [(0, self.raw)] + [(rollup.width, rollup) for rollup in self.rollups]
+
+    def pick_tier(self, start=None, resolution=None, now=None):
+        """Pick the ring to answer a query.
+
+        With a resolution, the coarsest tier whose bucket width does not
+        exceed it; otherwise the finest tier. Either way, move to coarser
+        tiers while the chosen one does not reach back to `start`.
+        Returns (ring, resolution in seconds).
+        """
+        now = now or time.time()
+        tiers = [(RAW_RESOLUTION, self.raw.capacity * RAW_RESOLUTION, self.raw)]
+        tiers += [(r.width, r.width * r.capacity, r) for r in self.rollups]
+
+        chosen = 0
+        if resolution:
+            for i, (width, _, _) in enumerate(tiers):
+                if width <= resolution:
+                    chosen = i
+        if start is not None:
+            while chosen < len(tiers) - 1 and start < now - tiers[chosen][1]:
+                chosen += 1
+        width, _, ring = tiers[chosen]
+        return ring, width
+
+class MetricsHistory:
+    """History for every device, keyed by (user_id, device_id) then metric name"""
+
+    def __init__(self, capacity=RAW_CAPACITY, tiers=ROLLUP_TIERS):
+        self.capacity = capacity
+        self.tiers = tiers
+        self._series = {}  # Format: {(user_id, device_id): {metric: MetricSeries}}
+        # Earliest sample time per (user_id, device_id, metric) appended since the last take_changes()
+        self._changed = {}
+
+    def _metric(self, user_id, device_id, name):
+        series = self._series.setdefault((user_id, device_id), {})
+        metric = series.get(name)
+        if metric is None:
+            metric = series[name] = MetricSeries(self.capacity, self.tiers)
+        return metric
+
+    def append(self, user_id, device_id, timestamp, metrics):
+        for name, value in metrics.items():
+            if self._metric(user_id, device_id, name).append(timestamp, value):
+                key = (user_id, device_id, name)
+                if timestamp < self._changed.get(key, timestamp + 1):
+                    self._changed[key] = timestamp
+
+    def metric_names(self, user_id, device_id):
+        return sorted(self._series.get((user_id, device_id), {}))
+
+    def query(self, user_id, device_id, metrics=None, start=None, end=None, resolution=None):
+        """Return {metric: {"resolution", "timestamps", "values", ...}} for the requested range.
+
+        Raw samples carry only values; rollup tiers add min, max and last
+        per bucket, with the bucket average as the value.
+        """
+        series = self._series.get((user_id, device_id), {})
+        result = {}
+        for name in metrics or sorted(series):
+            metric = series.get(name)
+            if metric is None:
+                continue
+            ring, width = metric.pick_tier(start, resolution)
+            result[name] = dict(resolution=width, **ring.range(start, end))
+        return result
+
+    def device_ids(self, user_id):
+        return sorted(device_id for user, device_id in self._series if user == user_id)
+
+    def export(self, user_id, device_ids, metrics=None, start=None, end=None, resolution=None):
+        """Yield one encoded columnar chunk (see EXPORT_MAGIC) per device and metric"""
+        for device_id in device_ids:
+            series = self._series.get((user_id, device_id), {})
+            for name in metrics or sorted(series):
+                metric = series.get(name)
+                if metric is None:
+                    continue
+                ring, width = metric.pick_tier(start, resolution)
+                yield encode_export_chunk(device_id, name, width, ring.export(start, end))
+
+    def drop_device(self, user_id, device_id):
+        self._series.pop((user_id, device_id), None)
+        self._changed = {key: t for key, t in self._changed.items() if key[:2] != (user_id, device_id)}
+
+    def retention(self):
+        """Seconds of history kept by the raw ring (key 0) and by each tier (key: bucket width)"""
+        return {0: self.capacity * RAW_RESOLUTION, **{width: width * buckets for width, buckets in self.tiers}}
+
+    @staticmethod
+    def chunk_span(width):
+        """Seconds covered by one persisted chunk of the ring with this width (0 = raw)"""
+        return (width or RAW_RESOLUTION) * CHUNK_ROWS
+
+    def take_changes(self):
+        """Persistable chunks of every ring changed by appends since the last call.
+
+        Returns [(user_id, device_id, metric, width, chunk start, data)] with
+        width 0 for the raw ring and data from dump_chunk(). Only chunks from
+        each series' earliest new sample onwards are included - usually just
+        the newest chunk of every ring.
+        """
+        changed, self._changed = self._changed, {}
+        rows = []
+        for (user_id, device_id, name), since in changed.items():
+            metric = self._series.get((user_id, device_id), {}).get(name)
+            if metric is None:
+                continue
+            for width, ring in metric.rings():
+                span = self.chunk_span(width)
+                rows += [
+                    (user_id, device_id, name, width, start, data)
+                    for start, data in ring.dump_chunks(since - since % span, span)
+                ]
+        return rows
+
+    def load_chunk(self, user_id, device_id, name, width, data):
+        """Restore one take_changes() chunk; load each ring's chunks oldest first"""
+        for ring_width, ring in self._metric(user_id, device_id, name).rings():
+            if ring_width != width:
+                continue
+            try:
+                ring.load_chunk(data)
+            except ValueError as e:
+                print(f"Warning: Discarding stored history chunk for {user_id}/{device_id} {name}: {e}")
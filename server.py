@@ -1,12 +1,43 @@
-from fastapi import FastAPI, Header, HTTPException, Depends
+from fastapi import FastAPI, Header, HTTPException, Depends, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Dict, List, Optional, Any
 import time
-from firebase_config import verify_token, get_firestore_db, initialize_firebase
+import os
+import zlib
+import asyncio
+import hashlib
+import json
+import itertools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from metrics_history import MetricsHistory, snapshot_metrics, EXPORT_MAGIC
+from storage import open_store
+from fleet import FleetAggregates
+from commands import DeviceCommandQueue, CommandIdGenerator, COMMAND_TTL
+from firebase_config import (
+    verify_token, get_firestore_db, initialize_firebase, device_exists, delete_device, run_firebase
+)
+
+@asynccontextmanager
+async def lifespan(app):
+    # Rebuild in-memory state from the local store, then persist changes in the background
+    state_store.load(device_stats, command_queue, metrics_history)
+    restamp_versions()
+    restore_command_queues()
+    state_store.start(metrics_history)
+    # Background flush of the Firestore write-behind buffer
+    firestore_writer.start()
+    sweeper = asyncio.get_running_loop().create_task(sweep_command_queues_periodically())
+    yield
+    sweeper.cancel()
+    await firestore_writer.stop()
+    await state_store.stop()
 
 # System Monitor API - Updated Dec 23, 2025
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Initialize Firebase
 initialize_firebase()
@@ -17,16 +48,83 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],  # Web clients read it for If-None-Match
 )
 
+# Largest request body accepted after gzip decompression
+MAX_INFLATED_BODY = 10 * 1024 * 1024
+
+class GZipRequestMiddleware:
+    """Inflates request bodies sent with Content-Encoding: gzip (agent updates)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or dict(scope["headers"]).get(b"content-encoding", b"").lower() != b"gzip":
+            await self.app(scope, receive, send)
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(body, MAX_INFLATED_BODY)
+        except zlib.error:
+            await self._reject(send, 400, b"Invalid gzip body")
+            return
+        if decompressor.unconsumed_tail:
+            await self._reject(send, 413, b"Request body too large")
+            return
+
+        headers = [(k, v) for k, v in scope["headers"] if k not in (b"content-encoding", b"content-length")]
+        headers.append((b"content-length", str(len(body)).encode()))
+        scope = dict(scope, headers=headers)
+
+        body_sent = False
+
+        async def inflated_receive():
+            nonlocal body_sent
+            if body_sent:
+                return await receive()
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        await self.app(scope, inflated_receive, send)
+
+    @staticmethod
+    async def _reject(send, status, detail):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": detail})
+
+app.add_middleware(GZipRequestMiddleware)
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
 # --- DATA MODEL ---
+class CommandAck(BaseModel):
+    id: int
+    success: bool = True
+    duration: Optional[float] = None  # Seconds the command ran on the agent
+    output: Optional[str] = None
+
+class AckBatch(BaseModel):
+    acks: List[CommandAck]
+
 class SystemStats(BaseModel):
     device_id: str
     user_id: str
-    cpu: float
-    ram: float
-    gpu: float
-    disk: Dict[str, float]
+    # Required in full snapshots; deltas only carry the fields that changed
+    cpu: Optional[float] = None
+    ram: Optional[float] = None
+    gpu: Optional[float] = None
+    disk: Optional[Dict[str, float]] = None
+    timestamp: Optional[float] = None  # Scheduled sample time (agent wall clock)
     cpu_details: Optional[Dict[str, Any]] = None
     ram_details: Optional[Dict[str, Any]] = None
     swap_details: Optional[Dict[str, Any]] = None
@@ -37,16 +135,156 @@ class SystemStats(BaseModel):
     battery: Optional[Dict[str, Any]] = None
     system: Optional[Dict[str, Any]] = None
     processes: Optional[Dict[str, Any]] = None
+    # Delta protocol: agents without seq always send full snapshots
+    seq: Optional[int] = None
+    full: bool = True
+    patch: Optional[Dict[str, Dict[str, Any]]] = None
+    # Results of commands delivered with a previous update response
+    acks: Optional[List[CommandAck]] = None
+
+# Fields of SystemStats that make up a device snapshot
+SNAPSHOT_FIELDS = [
+    "cpu", "ram", "gpu", "disk", "cpu_details", "ram_details", "swap_details",
+    "gpu_details", "disk_details", "disk_io", "network", "battery", "system",
+    "processes", "timestamp"
+]
+
+class StatsBatch(BaseModel):
+    samples: List[SystemStats]
+    acks: Optional[List[CommandAck]] = None
 
 class RemoteCommand(BaseModel):
     command: str
     params: Optional[Dict[str, Any]] = None
 
+class BulkCommand(BaseModel):
+    command: str
+    params: Optional[Dict[str, Any]] = None
+    # Exactly one target selector
+    device_ids: Optional[List[str]] = None
+    tag: Optional[str] = None  # Devices whose agent reports this tag (AGENT_TAGS)
+    all_devices: bool = False
+
 # In-memory storage (The "Mailbox") - Now organized by user_id and device_id
 device_stats = {}  # Format: {user_id: {device_id: {...stats}}}
 
+# Metric history per device (bounded rings, see metrics_history.py)
+metrics_history = MetricsHistory()
+
+# Every snapshot change gets the next version; device_list_versions holds each user's newest
+snapshot_versions = itertools.count(1)
+device_list_versions = {}  # Format: {user_id: version}
+
+def bump_version(user_id):
+    version = next(snapshot_versions)
+    device_list_versions[user_id] = version
+    return version
+
+def restamp_versions():
+    """Continue past versions loaded from the store and re-stamp loaded snapshots (their status changed)"""
+    global snapshot_versions
+    loaded = [s.get("version") or 0 for devices in device_stats.values() for s in devices.values()]
+    snapshot_versions = itertools.count(max(loaded, default=0) + 1)
+    for user_id, devices in device_stats.items():
+        for snapshot in devices.values():
+            snapshot["version"] = bump_version(user_id)
+
+# Per-user fleet aggregates, updated with each device's latest snapshot
+fleet_aggregates = FleetAggregates()
+
 # Command queue for remote control - organized by user_id and device_id
-command_queue = {}  # Format: {user_id: {device_id: [commands]}}
+command_queue = {}  # Format: {user_id: {device_id: DeviceCommandQueue}}
+
+# Unique, increasing ids for queued commands
+command_ids = CommandIdGenerator()
+
+def restore_command_queues():
+    """Turn command lists loaded from the store into queues"""
+    for devices in command_queue.values():
+        for device_id, commands in devices.items():
+            devices[device_id] = DeviceCommandQueue.from_list(commands)
+
+# Wakes long-polling agents when a command is queued for them
+command_events = {}  # Format: {user_id: {device_id: asyncio.Event}}
+command_waiters = {}  # Format: {(user_id, device_id): long-polls currently waiting}
+
+# Seconds between sweeps that expire commands of devices which never poll
+COMMAND_SWEEP_INTERVAL = 60
+
+# Sample timestamps further ahead of server time than this (seconds) are
+# replaced with server time; past ones are kept, e.g. spooled samples
+MAX_CLOCK_SKEW = 300
+
+# Longest time /api/commands/wait holds a request open (seconds)
+MAX_COMMAND_WAIT = 55
+
+# Local SQLite file for snapshots, command queues and history (empty disables persistence)
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "monitor_state.db")
+state_store = open_store(STATE_DB_PATH)
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a per-entry TTL"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+# Verified credentials, so auth does not cost a Firestore/JWT check per request
+DEVICE_AUTH_TTL = 300      # Registered device tokens
+NEGATIVE_AUTH_TTL = 60     # Unregistered devices and invalid Firebase tokens
+device_auth_cache = TTLCache()  # (user_id, device_id) -> (token hash, registered)
+firebase_token_cache = TTLCache()  # token hash -> decoded claims, or False if invalid
+
+# Responses to /api/command by Idempotency-Key, so client retries don't queue twice
+IDEMPOTENCY_TTL = 24 * 3600
+idempotent_commands = TTLCache()  # (user_id, key) -> (request fingerprint, response)
+
+# Longest command output kept from an ack
+MAX_ACK_OUTPUT = 4096
+
+# Bulk dispatches, kept for their aggregate result view until their commands can no longer be acked
+command_batches = TTLCache(maxsize=1000)  # (user_id, batch_id) -> batch
+BATCH_TTL = COMMAND_TTL + 3600
+
+def idempotent_response(user_id, key, fingerprint):
+    """Response of an earlier request with this Idempotency-Key, or None"""
+    if not key:
+        return None
+    previous = idempotent_commands.get((user_id, key))
+    if previous and previous[0] != fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different command")
+    return previous[1] if previous else None
+
+def remember_response(user_id, key, fingerprint, response):
+    if key:
+        idempotent_commands.set((user_id, key), (fingerprint, response), IDEMPOTENCY_TTL)
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def invalidate_device_auth(user_id, device_id):
+    """Forget cached verification for a device (e.g. after deregistration)"""
+    device_auth_cache.pop((user_id, device_id))
 
 # Helper function to verify authentication
 async def verify_auth(
@@ -54,52 +292,233 @@ async def verify_auth(
     x_user_id: Optional[str] = Header(None),
     authorization: Optional[str] = Header(None)
 ):
-    """Verify device authentication - supports both device tokens and Firebase ID tokens"""
+    """Verify device authentication - supports both device tokens and Firebase ID tokens.
+
+    Returns user_id and device_id plus how they were established: "method"
+    is "demo", "firebase" or "device", and "registered" tells whether a
+    device token's device was found in Firestore.
+    """
     if not x_user_id:
         raise HTTPException(status_code=401, detail="Missing user ID")
     
     # For demo mode, allow demo-user/demo-token
     if x_user_id == "demo-user" and authorization == "Bearer demo-token":
-        return {"user_id": x_user_id, "device_id": x_device_id or "demo-device"}
+        return {"user_id": x_user_id, "device_id": x_device_id or "demo-device", "method": "demo", "registered": True}
     
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid authorization token")
     
     token = authorization.split("Bearer ")[1]
+    token_hash = _token_hash(token)
     
     # Check if this is a device token (agent) or Firebase ID token (mobile app)
     # Device tokens are typically longer and URL-safe base64
     # Firebase ID tokens are JWT format (have dots)
     
     if "." in token:
-        # This looks like a Firebase ID token (JWT format)
-        user_info = verify_token(token)
+        # This looks like a Firebase ID token (JWT format) - cached until it expires
+        user_info = firebase_token_cache.get(token_hash)
+        if user_info is None:
+            try:
+                user_info = await run_firebase(verify_token, token)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=503, detail="Token verification timed out")
+            except Exception as e:
+                # Not the token's fault (e.g. Google certificates unreachable): don't cache it
+                print(f"Warning: Could not verify Firebase token: {e!r}")
+                raise HTTPException(status_code=503, detail="Token verification unavailable")
+            if user_info:
+                firebase_token_cache.set(token_hash, user_info, user_info.get("exp", 0) - time.time())
+            else:
+                firebase_token_cache.set(token_hash, False, NEGATIVE_AUTH_TTL)
         
         if not user_info:
             raise HTTPException(status_code=401, detail="Invalid Firebase token")
         
         # For mobile app requests, user_id should match token
         # device_id is optional (used for targeting commands)
-        return {"user_id": user_info.get("uid"), "device_id": x_device_id}
+        return {"user_id": user_info.get("uid"), "device_id": x_device_id, "method": "firebase", "registered": False}
     else:
         # This is a device token - verify it exists for this user/device
         if not x_device_id:
             raise HTTPException(status_code=401, detail="Missing device ID for device token")
         
+        cached = device_auth_cache.get((x_user_id, x_device_id))
+        if cached and cached[0] == token_hash:
+            return {"user_id": x_user_id, "device_id": x_device_id, "method": "device", "registered": cached[1]}
+        
+        registered = False
         try:
-            db = get_firestore_db()
-            if db:
-                device_doc = db.collection('users').document(x_user_id).collection('devices').document(x_device_id).get()
-                if device_doc.exists:
-                    # Device is registered, allow access
-                    return {"user_id": x_user_id, "device_id": x_device_id}
+            registered = await run_firebase(device_exists, x_user_id, x_device_id)
         except Exception as e:
-            print(f"Warning: Could not verify device in Firestore: {e}")
+            print(f"Warning: Could not verify device in Firestore: {e!r}")
+        
+        device_auth_cache.set(
+            (x_user_id, x_device_id), (token_hash, registered),
+            DEVICE_AUTH_TTL if registered else NEGATIVE_AUTH_TTL
+        )
         
         # If Firestore check fails or device not found, still allow for backward compatibility
         # In production, you should enforce strict validation
-        print(f"⚠️ Warning: Device {x_device_id} for user {x_user_id} not verified in Firestore")
-        return {"user_id": x_user_id, "device_id": x_device_id}
+        if not registered:
+            print(f"⚠️ Warning: Device {x_device_id} for user {x_user_id} not verified in Firestore")
+        return {"user_id": x_user_id, "device_id": x_device_id, "method": "device", "registered": registered}
+
+def apply_update(user_id, device_id, stats: SystemStats):
+    """Merge one full snapshot or delta into device_stats and return the new snapshot"""
+    # Initialize user storage if needed
+    if user_id not in device_stats:
+        device_stats[user_id] = {}
+    
+    previous = device_stats[user_id].get(device_id)
+    
+    if stats.full:
+        if stats.cpu is None or stats.ram is None or stats.gpu is None or stats.disk is None:
+            raise HTTPException(status_code=422, detail="Full snapshot is missing cpu/ram/gpu/disk")
+        snapshot = {field: getattr(stats, field) for field in SNAPSHOT_FIELDS}
+    else:
+        # Deltas only apply on top of the immediately preceding sequence number
+        if not previous or stats.seq is None or previous.get("seq") != stats.seq - 1:
+            print(f"[API] Sequence gap from {user_id}/{device_id} (got {stats.seq}), requesting resync")
+            raise HTTPException(status_code=409, detail="Resync required")
+        
+        snapshot = dict(previous)
+        for field in stats.model_fields_set:
+            if field in SNAPSHOT_FIELDS:
+                snapshot[field] = getattr(stats, field)
+        for field, changes in (stats.patch or {}).items():
+            if field in SNAPSHOT_FIELDS:
+                if not isinstance(snapshot.get(field), dict):
+                    raise HTTPException(status_code=422, detail=f"Cannot patch non-object field {field}")
+                snapshot[field] = {**snapshot[field], **changes}
+    
+    now = time.time()
+    snapshot["timestamp"] = stats.timestamp or now
+    if snapshot["timestamp"] > now + MAX_CLOCK_SKEW:
+        # A future-dated sample would make history reject every real one until the clock catches up
+        print(f"[API] Timestamp from {user_id}/{device_id} is {snapshot['timestamp'] - now:.0f}s ahead, using server time")
+        snapshot["timestamp"] = now
+    snapshot["seq"] = stats.seq
+    snapshot["status"] = "Online"
+    snapshot["version"] = bump_version(user_id)
+    
+    # Store device stats
+    device_stats[user_id][device_id] = snapshot
+    metrics_history.append(user_id, device_id, snapshot["timestamp"], snapshot_metrics(snapshot))
+    state_store.save_snapshot(user_id, device_id, snapshot)
+    return snapshot
+
+class FirestoreWriteBehind:
+    """Write-behind buffer for the per-device Firestore mirror.
+
+    Update requests only record the latest state per device, so request
+    latency does not depend on Firestore. A background task flushes the
+    buffer every flush_interval seconds in batched writes. A device is
+    written only when its persisted fields changed or the heartbeat
+    interval has passed since its last write.
+    """
+
+    # Fields that change every sample and alone don't warrant a write
+    VOLATILE_FIELDS = {"uptime_hours", "uptime_seconds", "time_left_minutes", "time_left_str"}
+    MAX_BATCH_WRITES = 500  # Firestore limit per batch
+
+    def __init__(self, flush_interval=5, heartbeat=60):
+        self.flush_interval = flush_interval
+        self.heartbeat = heartbeat
+        self._pending = {}    # (user_id, device_id) -> (document, fingerprint)
+        self._persisted = {}  # (user_id, device_id) -> (fingerprint, written_at)
+        self._task = None
+        self._fallback_flush = None  # Flush task started by submit() when _task isn't running
+        self._last_flush = time.monotonic()
+
+    def _fingerprint(self, system, battery):
+        stable = [
+            {k: v for k, v in (part or {}).items() if k not in self.VOLATILE_FIELDS}
+            for part in (system, battery)
+        ]
+        return json.dumps(stable, sort_keys=True, default=str)
+
+    def submit(self, user_id, device_id, system, battery):
+        """Record the device's latest state; it is written on a later flush"""
+        self._pending[(user_id, device_id)] = ({
+            'last_update': time.time(),
+            'status': 'Online',
+            'system': system,
+            'battery': battery
+        }, self._fingerprint(system, battery))
+        
+        # Without the background task (e.g. lifespan not run) flush from the event loop instead
+        if self._task is None and time.monotonic() - self._last_flush >= self.flush_interval:
+            if self._fallback_flush is not None and not self._fallback_flush.done():
+                return  # The previous one is still writing
+            self._last_flush = time.monotonic()
+            self._fallback_flush = asyncio.get_running_loop().create_task(self.flush())
+
+    def forget(self, user_id, device_id):
+        self._pending.pop((user_id, device_id), None)
+        self._persisted.pop((user_id, device_id), None)
+
+    async def flush(self):
+        """Write every due device in batched Firestore commits"""
+        self._last_flush = time.monotonic()
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        due = []
+        for key, (document, fingerprint) in pending.items():
+            persisted = self._persisted.get(key)
+            if persisted and persisted[0] == fingerprint and now - persisted[1] < self.heartbeat:
+                continue
+            due.append((key, document, fingerprint))
+        
+        for start in range(0, len(due), self.MAX_BATCH_WRITES):
+            chunk = due[start:start + self.MAX_BATCH_WRITES]
+            try:
+                await run_firebase(self._commit, chunk, timeout=30)
+            except Exception as e:
+                print(f"Warning: Could not update Firestore: {e}")
+                # Retry on the next flush unless a newer state has arrived meanwhile
+                for key, document, fingerprint in chunk:
+                    self._pending.setdefault(key, (document, fingerprint))
+                continue
+            for key, document, fingerprint in chunk:
+                self._persisted[key] = (fingerprint, now)
+
+    def _commit(self, chunk):
+        db = get_firestore_db()
+        batch = db.batch()
+        for (user_id, device_id), document, _ in chunk:
+            ref = db.collection('users').document(user_id).collection('devices').document(device_id)
+            batch.set(ref, document, merge=True)
+        batch.commit()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+firestore_writer = FirestoreWriteBehind()
+
+def store_device_state(user_id, device_id, snapshot):
+    """Queue the device's latest system/battery info for the Firestore mirror"""
+    system = snapshot.get("system")
+    battery = snapshot.get("battery")
+    os_name = system.get('os_name', 'Unknown') if system else 'Unknown'
+    battery_info = f" | Battery: {battery['percent']}%" if battery else ""
+    print(f"[API] Update from {user_id}/{device_id} - {os_name}{battery_info} | CPU: {snapshot['cpu']}% | RAM: {snapshot['ram']}%")
+    
+    fleet_aggregates.update(user_id, device_id, snapshot)
+    
+    # Optionally store in Firebase Firestore (written behind, off the request path)
+    firestore_writer.submit(user_id, device_id, system, battery)
 
 # --- ENDPOINT 1: RECEIVE DATA (POST) ---
 @app.post("/api/update")
@@ -107,102 +526,458 @@ async def update_stats(stats: SystemStats, auth_info: dict = Depends(verify_auth
     user_id = auth_info["user_id"]
     device_id = auth_info["device_id"]
     
-    # Initialize user storage if needed
-    if user_id not in device_stats:
-        device_stats[user_id] = {}
+    snapshot = apply_update(user_id, device_id, stats)
+    store_device_state(user_id, device_id, snapshot)
     
-    # Store device stats
-    device_stats[user_id][device_id] = {
-        "cpu": stats.cpu,
-        "ram": stats.ram,
-        "gpu": stats.gpu,
-        "disk": stats.disk,
-        "cpu_details": stats.cpu_details,
-        "ram_details": stats.ram_details,
-        "swap_details": stats.swap_details,
-        "gpu_details": stats.gpu_details,
-        "disk_details": stats.disk_details,
-        "disk_io": stats.disk_io,
-        "network": stats.network,
-        "battery": stats.battery,
-        "system": stats.system,
-        "processes": stats.processes,
-        "status": "Online"
+    # Piggybacked acks in, pending commands out - no separate poll/ack round trips
+    for ack in stats.acks or []:
+        ack_command(user_id, device_id, ack)
+    
+    return {
+        "message": "Data received successfully",
+        "seq": stats.seq,
+        "commands": take_pending_commands(user_id, device_id)
     }
+
+# --- ENDPOINT 1B: RECEIVE BUFFERED SAMPLES (POST) ---
+@app.post("/api/update/batch")
+async def update_stats_batch(batch: StatsBatch, auth_info: dict = Depends(verify_auth)):
+    user_id = auth_info["user_id"]
+    device_id = auth_info["device_id"]
     
-    os_name = stats.system.get('os_name', 'Unknown') if stats.system else 'Unknown'
-    battery_info = f" | Battery: {stats.battery['percent']}%" if stats.battery else ""
-    print(f"[API] Update from {user_id}/{device_id} - {os_name}{battery_info} | CPU: {stats.cpu}% | RAM: {stats.ram}%")
+    if not batch.samples:
+        return {"message": "No samples", "accepted": 0}
     
-    # Optionally store in Firebase Firestore
-    try:
-        db = get_firestore_db()
-        if db:
-            db.collection('users').document(user_id).collection('devices').document(device_id).set({
-                'last_update': time.time(),
-                'status': 'Online',
-                'system': stats.system,
-                'battery': stats.battery
-            }, merge=True)
-    except Exception as e:
-        print(f"Warning: Could not update Firestore: {e}")
+    # Samples are applied oldest first; only the newest one is mirrored to Firestore
+    for stats in batch.samples:
+        snapshot = apply_update(user_id, device_id, stats)
+    store_device_state(user_id, device_id, snapshot)
+    
+    print(f"[API] Batch of {len(batch.samples)} samples from {user_id}/{device_id}")
+    
+    for ack in batch.acks or []:
+        ack_command(user_id, device_id, ack)
+    
+    return {
+        "message": "Data received successfully",
+        "accepted": len(batch.samples),
+        "seq": batch.samples[-1].seq,
+        "commands": take_pending_commands(user_id, device_id)
+    }
+
+def summarize_snapshot(snapshot):
+    """Compact shape with just the headline numbers a device list or tile shows"""
+    battery = snapshot.get("battery")
+    system = snapshot.get("system") or {}
+    return {
+        "cpu": snapshot.get("cpu"),
+        "ram": snapshot.get("ram"),
+        "gpu": snapshot.get("gpu"),
+        "disk": snapshot.get("disk"),
+        "battery": {"percent": battery.get("percent"), "plugged": battery.get("plugged")} if battery else None,
+        "system": {"os_name": system.get("os_name"), "hostname": system.get("hostname")},
+        "status": snapshot.get("status"),
+        "timestamp": snapshot.get("timestamp"),
+        "seq": snapshot.get("seq"),
+        "version": snapshot.get("version")
+    }
+
+def project_snapshot(snapshot, fields=None, shape="full"):
+    """Return the requested view of a snapshot.
+
+    shape is "full" or "summary"; fields is a comma-separated list of keys
+    to keep from that shape, where "section.key" keeps a single key of a
+    nested section (e.g. "cpu,ram,system.os_name").
+    """
+    if shape not in ("full", "summary"):
+        raise HTTPException(status_code=422, detail="shape must be 'full' or 'summary'")
+    view = summarize_snapshot(snapshot) if shape == "summary" else snapshot
+    if not fields:
+        return view
     
-    return {"message": "Data received successfully"}
+    projected = {}
+    for field in (f.strip() for f in fields.split(",")):
+        section, _, key = field.partition(".")
+        if section not in view:
+            continue
+        if not key:
+            projected[section] = view[section]
+        elif isinstance(view[section], dict) and key in view[section]:
+            nested = projected.setdefault(section, {})
+            if isinstance(nested, dict) and nested is not view[section]:
+                nested[key] = view[section][key]
+    return projected
+
+def make_etag(version, fields, shape):
+    """ETag for one version of a projected view"""
+    return f'"{version}-{shape}-{zlib.crc32((fields or "").encode()):08x}"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
 
 # --- ENDPOINT 2: SEND DATA (GET) - Get stats for specific device ---
 @app.get("/api/status")
-async def get_stats(auth_info: dict = Depends(verify_auth)):
+async def get_stats(
+    response: Response,
+    fields: Optional[str] = None,
+    shape: str = "full",
+    since_version: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None),
+    auth_info: dict = Depends(verify_auth)
+):
+    """Latest snapshot; 304 on a matching If-None-Match, an empty delta if unchanged since since_version"""
     user_id = auth_info["user_id"]
     device_id = auth_info["device_id"]
     
     if user_id in device_stats and device_id in device_stats[user_id]:
-        return device_stats[user_id][device_id]
+        snapshot = device_stats[user_id][device_id]
+        version = snapshot.get("version")
+        etag = make_etag(version, fields, shape)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+        if since_version is not None and version <= since_version:
+            return {"version": version, "changed": False}
+        return project_snapshot(snapshot, fields, shape)
     
     return {"status": "Waiting for Agent...", "message": "No data available"}
 
 # --- ENDPOINT 2B: Get all devices for a user ---
 @app.get("/api/devices")
-async def get_all_devices(auth_info: dict = Depends(verify_auth)):
+async def get_all_devices(
+    response: Response,
+    fields: Optional[str] = None,
+    shape: str = "full",
+    since_version: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None),
+    auth_info: dict = Depends(verify_auth)
+):
+    """All devices of the user.
+
+    With since_version only devices changed after it are listed, and
+    device_ids names every current device so removals can be detected.
+    """
+    user_id = auth_info["user_id"]
+    version = device_list_versions.get(user_id, 0)
+    etag = make_etag(f"{version}.{since_version}", fields, shape)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    
+    devices = device_stats.get(user_id, {})
+    result = {
+        "version": version,
+        "devices": [
+            {
+                "device_id": dev_id,
+                "stats": project_snapshot(stats, fields, shape)
+            }
+            for dev_id, stats in devices.items()
+            if since_version is None or stats.get("version", 0) > since_version
+        ]
+    }
+    if since_version is not None:
+        result["device_ids"] = list(devices)
+    return result
+
+# --- ENDPOINT 2B2: Fleet summary for a user ---
+@app.get("/api/fleet/summary")
+async def get_fleet_summary(auth_info: dict = Depends(verify_auth)):
+    """Aggregates over the user's online devices, maintained as updates arrive"""
+    user_id = auth_info["user_id"]
+    return {
+        "devices": len(device_stats.get(user_id, {})),
+        "online_window": fleet_aggregates.online_window,
+        **fleet_aggregates.summary(user_id)
+    }
+
+# --- ENDPOINT 2C: Metric history for a device ---
+@app.get("/api/history")
+async def get_history(
+    metrics: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    resolution: Optional[float] = None,
+    auth_info: dict = Depends(verify_auth)
+):
+    """Range query over a device's metric history (metrics is a comma-separated list).
+    
+    Served from the coarsest rollup tier that satisfies `resolution` (seconds),
+    or the finest tier that still covers `start` when no resolution is given.
+    """
+    user_id = auth_info["user_id"]
+    device_id = auth_info["device_id"]
+    names = [m.strip() for m in metrics.split(",") if m.strip()] if metrics else None
+    
+    return {
+        "device_id": device_id,
+        "available": metrics_history.metric_names(user_id, device_id),
+        "metrics": metrics_history.query(user_id, device_id, names, start, end, resolution)
+    }
+
+# --- ENDPOINT 2D: Bulk columnar history export ---
+@app.get("/api/history/export")
+async def export_history(
+    metrics: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    resolution: Optional[float] = None,
+    scope: str = "device",
+    auth_info: dict = Depends(verify_auth)
+):
+    """Stream history as compact columnar binary (layout in metrics_history.EXPORT_MAGIC).
+
+    scope=device exports the calling device, scope=user every device of the
+    user. Only the requested metrics and time range are encoded, one chunk
+    per series, so the response is never built fully in memory.
+    """
     user_id = auth_info["user_id"]
+    if scope not in ("device", "user"):
+        raise HTTPException(status_code=422, detail="scope must be 'device' or 'user'")
+    device_ids = metrics_history.device_ids(user_id) if scope == "user" else [auth_info["device_id"]]
+    names = [m.strip() for m in metrics.split(",") if m.strip()] if metrics else None
     
-    if user_id in device_stats:
-        return {
-            "devices": [
-                {
-                    "device_id": dev_id,
-                    "stats": stats
-                } 
-                for dev_id, stats in device_stats[user_id].items()
-            ]
-        }
+    async def stream():
+        yield EXPORT_MAGIC
+        for chunk in metrics_history.export(user_id, device_ids, names, start, end, resolution):
+            yield chunk
+            await asyncio.sleep(0)  # Let updates run between chunks
     
-    return {"devices": []}
+    return StreamingResponse(stream(), media_type="application/octet-stream")
+
+# --- ENDPOINT 2E: Deregister a device ---
+@app.delete("/api/devices/{device_id}")
+async def deregister_device(device_id: str, auth_info: dict = Depends(verify_auth)):
+    user_id = auth_info["user_id"]
+    # Unregistered device tokens are only tolerated for reporting stats, not for removing devices
+    own_device = auth_info["method"] == "device" and auth_info["registered"] and auth_info["device_id"] == device_id
+    if auth_info["method"] not in ("demo", "firebase") and not own_device:
+        raise HTTPException(status_code=403, detail="Only a signed-in user or the device itself can deregister it")
+    
+    try:
+        await run_firebase(delete_device, user_id, device_id)
+    except Exception as e:
+        print(f"Warning: Could not delete device from Firestore: {e!r}")
+    
+    if device_stats.get(user_id, {}).pop(device_id, None):
+        bump_version(user_id)
+    command_queue.get(user_id, {}).pop(device_id, None)
+    command_events.get(user_id, {}).pop(device_id, None)
+    metrics_history.drop_device(user_id, device_id)
+    firestore_writer.forget(user_id, device_id)
+    fleet_aggregates.remove(user_id, device_id)
+    state_store.delete_device(user_id, device_id)
+    invalidate_device_auth(user_id, device_id)
+    
+    print(f"[API] Device {user_id}/{device_id} deregistered")
+    return {"message": "Device deregistered"}
 
 @app.get("/")
 def root():
     return {"message": "System Monitor API", "status": "running"}
 
-# --- ENDPOINT 3: SEND REMOTE COMMAND (POST) ---
-@app.post("/api/command")
-async def send_command(command: RemoteCommand, target_device_id: str, auth_info: dict = Depends(verify_auth)):
-    user_id = auth_info["user_id"]
+def take_pending_commands(user_id, device_id):
+    """Return the device's commands due for delivery (new or unacked past the visibility timeout)"""
+    queue = command_queue.get(user_id, {}).get(device_id)
+    if queue is None:
+        return []
     
-    # Initialize command queue for user if needed
-    if user_id not in command_queue:
-        command_queue[user_id] = {}
-    if target_device_id not in command_queue[user_id]:
-        command_queue[user_id][target_device_id] = []
+    queued = len(queue)
+    pending = queue.take()
+    if pending or len(queue) != queued:
+        state_store.save_commands(user_id, device_id, queue)
+    return pending
+
+def ack_command(user_id, device_id, ack: CommandAck):
+    """Drop an executed command from the device's queue; returns False if it was not queued"""
+    queue = command_queue.get(user_id, {}).get(device_id)
+    command = queue.ack(ack.id) if queue is not None else None
+    if command:
+        state_store.save_commands(user_id, device_id, queue)
+        batch = command_batches.get((user_id, command.get("batch_id")))
+        if batch:
+            batch["results"][device_id] = {
+                "success": ack.success,
+                "duration": ack.duration,
+                "output": ack.output[:MAX_ACK_OUTPUT] if ack.output else ack.output
+            }
     
+    duration = f" in {ack.duration:.2f}s" if ack.duration is not None else ""
+    print(f"[API] Command {ack.id} acknowledged from {user_id}/{device_id}: {'Success' if ack.success else 'Failed'}{duration}")
+    return command is not None
+
+def get_command_event(user_id, device_id):
+    """Event set whenever a command is queued for the device"""
+    return command_events.setdefault(user_id, {}).setdefault(device_id, asyncio.Event())
+
+def sweep_command_queues():
+    """Expire commands in every queue, including devices that never poll.
+
+    Emptied queues are dropped together with their long-poll event (unless
+    a long-poll is waiting on it), so queues for unknown device ids don't
+    accumulate.
+    """
+    for user_id, queues in list(command_queue.items()):
+        for device_id, queue in list(queues.items()):
+            queued = len(queue)
+            queue.expire()
+            if len(queue) != queued:
+                state_store.save_commands(user_id, device_id, queue)
+            if queue:
+                continue
+            del queues[device_id]
+            if (user_id, device_id) not in command_waiters:
+                command_events.get(user_id, {}).pop(device_id, None)
+        if not queues:
+            del command_queue[user_id]
+        if not command_events.get(user_id, True):
+            del command_events[user_id]
+
+async def sweep_command_queues_periodically():
+    while True:
+        await asyncio.sleep(COMMAND_SWEEP_INTERVAL)
+        sweep_command_queues()
+
+def queue_command(user_id, device_id, command, params, batch_id=None):
+    """Queue one command for a device, wake its long-poll and return the command"""
+    queue = command_queue.setdefault(user_id, {}).setdefault(device_id, DeviceCommandQueue())
     command_data = {
-        "id": int(time.time() * 1000),  # Unique ID
-        "command": command.command,
-        "params": command.params or {},
+        "id": command_ids.next_id(),
+        "command": command,
+        "params": params or {},
         "timestamp": time.time(),
         "status": "pending"
     }
-    command_queue[user_id][target_device_id].append(command_data)
+    if batch_id is not None:
+        command_data["batch_id"] = batch_id
+    queue.enqueue(command_data)
+    state_store.save_commands(user_id, device_id, queue)
+    get_command_event(user_id, device_id).set()
+    return command_data
+
+# --- ENDPOINT 3: SEND REMOTE COMMAND (POST) ---
+@app.post("/api/command")
+async def send_command(
+    command: RemoteCommand,
+    target_device_id: str,
+    idempotency_key: Optional[str] = Header(None),
+    auth_info: dict = Depends(verify_auth)
+):
+    """Queue a command for a device.
+
+    A request repeating an earlier Idempotency-Key (within IDEMPOTENCY_TTL)
+    gets the original response back instead of queueing the command again.
+    """
+    user_id = auth_info["user_id"]
+    
+    fingerprint = json.dumps([target_device_id, command.command, command.params or {}], sort_keys=True, default=str)
+    previous = idempotent_response(user_id, idempotency_key, fingerprint)
+    if previous:
+        return previous
+    
+    command_data = queue_command(user_id, target_device_id, command.command, command.params)
     print(f"[API] Command received for {user_id}/{target_device_id}: {command.command}")
-    return {"message": "Command queued successfully", "command_id": command_data["id"]}
+    
+    response = {"message": "Command queued successfully", "command_id": command_data["id"]}
+    remember_response(user_id, idempotency_key, fingerprint, response)
+    return response
+
+# --- ENDPOINT 3B: SEND A COMMAND TO MANY DEVICES (POST) ---
+@app.post("/api/commands/bulk")
+async def send_bulk_command(
+    bulk: BulkCommand,
+    idempotency_key: Optional[str] = Header(None),
+    auth_info: dict = Depends(verify_auth)
+):
+    """Queue one command for a list of devices, every device with a tag, or all of the user's devices.
+
+    Returns the batch id and each device's command id; the aggregate
+    result is at GET /api/commands/bulk/{batch_id}.
+    """
+    user_id = auth_info["user_id"]
+    
+    if sum([bulk.device_ids is not None, bulk.tag is not None, bulk.all_devices]) != 1:
+        raise HTTPException(status_code=422, detail="Give exactly one of device_ids, tag or all_devices")
+    
+    fingerprint = json.dumps(bulk.model_dump(), sort_keys=True, default=str)
+    previous = idempotent_response(user_id, idempotency_key, fingerprint)
+    if previous:
+        return previous
+    
+    devices = device_stats.get(user_id, {})
+    if bulk.device_ids is not None:
+        targets = list(dict.fromkeys(bulk.device_ids))
+    elif bulk.tag is not None:
+        targets = [
+            device_id for device_id, snapshot in devices.items()
+            if bulk.tag in ((snapshot.get("system") or {}).get("tags") or [])
+        ]
+    else:
+        targets = list(devices)
+    if not targets:
+        raise HTTPException(status_code=404, detail="No devices matched")
+    
+    batch_id = command_ids.next_id()
+    command_ids_by_device = {
+        device_id: queue_command(user_id, device_id, bulk.command, bulk.params, batch_id)["id"]
+        for device_id in targets
+    }
+    command_batches.set((user_id, batch_id), {
+        "command": bulk.command,
+        "created": time.time(),
+        "commands": command_ids_by_device,
+        "results": {}  # device_id -> success, filled in by acks
+    }, BATCH_TTL)
+    print(f"[API] Bulk command {bulk.command} queued for {len(targets)} devices of {user_id} (batch {batch_id})")
+    
+    response = {
+        "message": "Command queued successfully",
+        "batch_id": batch_id,
+        "commands": command_ids_by_device
+    }
+    remember_response(user_id, idempotency_key, fingerprint, response)
+    return response
+
+# --- ENDPOINT 3C: AGGREGATE RESULT OF A BULK COMMAND (GET) ---
+@app.get("/api/commands/bulk/{batch_id}")
+async def get_bulk_command(batch_id: int, auth_info: dict = Depends(verify_auth)):
+    """Per-device state of a bulk command plus counts: pending, sent, succeeded, failed, expired"""
+    user_id = auth_info["user_id"]
+    batch = command_batches.get((user_id, batch_id))
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired batch")
+    
+    states = {}
+    for device_id, command_id in batch["commands"].items():
+        if device_id in batch["results"]:
+            states[device_id] = "succeeded" if batch["results"][device_id]["success"] else "failed"
+        else:
+            queued = command_queue.get(user_id, {}).get(device_id)
+            command = None
+            if queued is not None:
+                # Devices that never poll don't run expiry themselves
+                count = len(queued)
+                queued.expire()
+                if len(queued) != count:
+                    state_store.save_commands(user_id, device_id, queued)
+                command = queued.get(command_id)
+            states[device_id] = command["status"] if command else "expired"
+    
+    counts = {state: 0 for state in ("pending", "sent", "succeeded", "failed", "expired")}
+    for state in states.values():
+        counts[state] += 1
+    return {
+        "batch_id": batch_id,
+        "command": batch["command"],
+        "created": batch["created"],
+        "total": len(states),
+        "counts": counts,
+        "devices": states,
+        "results": batch["results"]  # Duration and output of every acked device
+    }
 
 # --- ENDPOINT 4: GET PENDING COMMANDS (GET) ---
 @app.get("/api/commands")
@@ -210,16 +985,31 @@ async def get_commands(auth_info: dict = Depends(verify_auth)):
     user_id = auth_info["user_id"]
     device_id = auth_info["device_id"]
     
-    if user_id not in command_queue or device_id not in command_queue[user_id]:
-        return {"commands": []}
-    
     # Return pending commands for this device
-    pending = [cmd for cmd in command_queue[user_id][device_id] if cmd["status"] == "pending"]
+    return {"commands": take_pending_commands(user_id, device_id)}
+
+# --- ENDPOINT 4B: WAIT FOR COMMANDS (LONG-POLL GET) ---
+@app.get("/api/commands/wait")
+async def wait_for_commands(timeout: float = 25, auth_info: dict = Depends(verify_auth)):
+    """Hold the request open until a command is queued for this device or the timeout passes"""
+    user_id = auth_info["user_id"]
+    device_id = auth_info["device_id"]
+    event = get_command_event(user_id, device_id)
     
-    # Mark as sent
-    for cmd in command_queue[user_id][device_id]:
-        if cmd["status"] == "pending":
-            cmd["status"] = "sent"
+    pending = take_pending_commands(user_id, device_id)
+    if not pending:
+        event.clear()
+        key = (user_id, device_id)
+        command_waiters[key] = command_waiters.get(key, 0) + 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout=min(max(timeout, 0), MAX_COMMAND_WAIT))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            command_waiters[key] -= 1
+            if not command_waiters[key]:
+                del command_waiters[key]
+        pending = take_pending_commands(user_id, device_id)
     
     return {"commands": pending}
 
@@ -229,10 +1019,15 @@ async def acknowledge_command(command_id: int, success: bool = True, auth_info:
     user_id = auth_info["user_id"]
     device_id = auth_info["device_id"]
     
-    if user_id in command_queue and device_id in command_queue[user_id]:
-        command_queue[user_id][device_id] = [
-            cmd for cmd in command_queue[user_id][device_id] if cmd["id"] != command_id
-        ]
+    ack_command(user_id, device_id, CommandAck(id=command_id, success=success))
+    return {"message": "Command acknowledged"}
+
+# --- ENDPOINT 5B: ACKNOWLEDGE MANY COMMANDS AT ONCE (POST) ---
+@app.post("/api/commands/ack")
+async def acknowledge_commands(batch: AckBatch, auth_info: dict = Depends(verify_auth)):
+    """Results of several executed commands (id, success, duration, output) in one request"""
+    user_id = auth_info["user_id"]
+    device_id = auth_info["device_id"]
     
-    print(f"[API] Command {command_id} acknowledged from {user_id}/{device_id}: {'Success' if success else 'Failed'}")
-    return {"message": "Command acknowledged"}
\ No newline at end of file
+    known = sum(ack_command(user_id, device_id, ack) for ack in batch.acks)
+    return {"message": "Commands acknowledged", "acknowledged": known, "unknown": len(batch.acks) - known}
\ No newline at end of file
@@ -0,0 +1,184 @@
+"""
+Disk-backed spool for samples the agent could not upload yet.
+Keeps history across restarts and long offline periods with bounded memory.
+"""
+import json
+import os
+import struct
+
+# Record header: 4-byte big-endian length of the JSON body that follows
+HEADER = struct.Struct(">I")
+
+class SampleSpool:
+    """Append-only, size-capped spool of unsent samples on local disk.
+
+    Records are length-prefixed JSON appended to numbered segment files. A new
+    segment is started once the active one reaches segment_bytes. When the
+    whole spool grows past max_bytes the oldest segments are deleted first.
+    Replay is in order from a persisted read cursor, a bounded batch at a time:
+    peek() returns the next records and consume() advances past them, removing
+    segments that have been fully read.
+    """
+
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024, segment_bytes=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.dropped_segments = 0
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments = sorted(
+            int(name[:-4]) for name in os.listdir(directory)
+            if name.endswith(".seg") and name[:-4].isdigit()
+        )
+        self._writer = None
+        self._peeked = []  # (segment, end offset) of each record returned by peek()
+        self._cursor = self._load_cursor()
+        self._repair_tail()
+
+    # --- Paths and cursor ---
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.seg")
+
+    def _cursor_path(self):
+        return os.path.join(self.directory, "cursor")
+
+    def _load_cursor(self):
+        try:
+            with open(self._cursor_path()) as f:
+                segment, offset = (int(x) for x in f.read().split())
+        except (OSError, ValueError):
+            segment, offset = 0, 0
+        if not self._segments:
+            return (0, 0)
+        if segment < self._segments[0] or segment not in self._segments:
+            return (self._segments[0], 0)
+        return (segment, offset)
+
+    def _save_cursor(self):
+        tmp_path = self._cursor_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(f"{self._cursor[0]} {self._cursor[1]}")
+        os.replace(tmp_path, self._cursor_path())
+
+    def _repair_tail(self):
+        """Truncate a partial record left at the end of the active segment by a crash"""
+        if not self._segments:
+            return
+        path = self._segment_path(self._segments[-1])
+        valid_end = 0
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                length = HEADER.unpack(header)[0]
+                if len(f.read(length)) < length:
+                    break
+                valid_end = f.tell()
+        if valid_end < os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(valid_end)
+
+    # --- Writing ---
+    def append(self, record):
+        """Append one JSON-serializable record"""
+        self.extend([record])
+
+    def extend(self, records):
+        """Append records in order, rotating segments and enforcing the size cap"""
+        for record in records:
+            body = json.dumps(record, separators=(",", ":")).encode("utf-8")
+            writer = self._active_writer()
+            writer.write(HEADER.pack(len(body)) + body)
+            if writer.tell() >= self.segment_bytes:
+                self._close_writer()
+        if self._writer:
+            self._writer.flush()
+        self._enforce_cap()
+
+    def _active_writer(self):
+        if self._writer is None:
+            if not self._segments or os.path.getsize(self._segment_path(self._segments[-1])) >= self.segment_bytes:
+                self._segments.append(self._segments[-1] + 1 if self._segments else 1)
+                if len(self._segments) == 1:
+                    self._cursor = (self._segments[0], 0)
+            self._writer = open(self._segment_path(self._segments[-1]), "ab")
+        return self._writer
+
+    def _close_writer(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    def _enforce_cap(self):
+        while len(self._segments) > 1 and self.size_bytes() > self.max_bytes:
+            oldest = self._segments.pop(0)
+            os.remove(self._segment_path(oldest))
+            self.dropped_segments += 1
+            self._peeked = []
+            if self._cursor[0] == oldest:
+                self._cursor = (self._segments[0], 0)
+                self._save_cursor()
+            print(f"⚠️ Spool over {self.max_bytes // (1024 * 1024)} MB, dropped oldest segment {oldest}")
+
+    # --- Reading ---
+    def size_bytes(self):
+        """Bytes on disk, including records already read but not yet cleaned up"""
+        return sum(os.path.getsize(self._segment_path(s)) for s in self._segments)
+
+    def is_empty(self):
+        if not self._segments:
+            return True
+        segment, offset = self._cursor
+        last = self._segments[-1]
+        return segment == last and offset >= os.path.getsize(self._segment_path(last))
+
+    def peek(self, limit):
+        """Return up to `limit` of the oldest unconsumed records without removing them"""
+        if self._writer:
+            self._writer.flush()
+        records = []
+        self._peeked = []
+        segment, offset = self._cursor
+        for seg in [s for s in self._segments if s >= segment]:
+            with open(self._segment_path(seg), "rb") as f:
+                f.seek(offset if seg == segment else 0)
+                while len(records) < limit:
+                    header = f.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+                    length = HEADER.unpack(header)[0]
+                    body = f.read(length)
+                    if len(body) < length:
+                        break  # Partial record left by a crash mid-write
+                    try:
+                        records.append(json.loads(body))
+                    except ValueError:
+                        if records:
+                            return records  # Skipped on the next peek, once it is at the head
+                        self._cursor = (seg, f.tell())
+                        continue
+                    self._peeked.append((seg, f.tell()))
+            if len(records) >= limit:
+                break
+        return records
+
+    def consume(self, count):
+        """Drop the first `count` records returned by the last peek()"""
+        if not self._peeked or count <= 0:
+            return
+        segment, offset = self._peeked[min(count, len(self._peeked)) - 1]
+        self._peeked = []
+
+        # Remove segments that are now fully read (the active one is kept)
+        while self._segments[0] < segment:
+            os.remove(self._segment_path(self._segments.pop(0)))
+        if segment != self._segments[-1] and offset >= os.path.getsize(self._segment_path(segment)):
+            os.remove(self._segment_path(self._segments.pop(0)))
+            segment, offset = self._segments[0], 0
+        self._cursor = (segment, offset)
+        self._save_cursor()
+
+    def close(self):
+        self._close_writer()
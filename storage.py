@@ -0,0 +1,211 @@
+"""
+Local persistence for server state: latest device snapshots, command queues
+and metric history survive restarts without any external service.
+"""
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    user_id TEXT NOT NULL, device_id TEXT NOT NULL, data TEXT NOT NULL,
+    PRIMARY KEY (user_id, device_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS commands (
+    user_id TEXT NOT NULL, device_id TEXT NOT NULL, data TEXT NOT NULL,
+    PRIMARY KEY (user_id, device_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS chunks (
+    user_id TEXT NOT NULL, device_id TEXT NOT NULL, metric TEXT NOT NULL, width INTEGER NOT NULL,
+    start REAL NOT NULL, data BLOB NOT NULL,
+    UNIQUE (user_id, device_id, metric, width, start)
+);
+CREATE INDEX IF NOT EXISTS chunks_by_age ON chunks (width, start);
+"""
+
+class NullStore:
+    """Store used when persistence is disabled: writes are dropped, nothing loads"""
+
+    def save_snapshot(self, user_id, device_id, snapshot):
+        pass
+
+    def save_commands(self, user_id, device_id, commands):
+        pass
+
+    def delete_device(self, user_id, device_id):
+        pass
+
+    def load(self, device_stats, command_queue, history):
+        pass
+
+    def start(self, history):
+        pass
+
+    async def stop(self):
+        pass
+
+class SQLiteStore(NullStore):
+    """SQLite store (WAL mode) with batched, write-behind commits.
+
+    Calls from request handlers only record the change in memory. A
+    background task commits everything recorded in one transaction every
+    flush_interval seconds, on a dedicated writer thread. Metric history is
+    persisted as chunks of each ring's column bytes: each flush rewrites only
+    the chunks new samples landed in, every prune_interval seconds chunks
+    past their ring's retention are deleted, and load() restores rings with
+    array.frombytes instead of replaying rows one by one.
+    """
+
+    def __init__(self, path, flush_interval=2, prune_interval=300):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.prune_interval = prune_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+        self._snapshots = {}  # (user_id, device_id) -> snapshot
+        self._commands = {}   # (user_id, device_id) -> iterable of command dicts
+        self._chunks = []     # Rows from history.take_changes() not yet written
+        self._deleted = set()
+        self._history = None
+        self._task = None
+        self._fallback_flush = None  # Flush task started by _flush_soon() when _task isn't running
+        self._last_flush = time.monotonic()
+
+    # --- Recording changes (event loop) ---
+    def save_snapshot(self, user_id, device_id, snapshot):
+        self._snapshots[(user_id, device_id)] = snapshot
+        self._flush_soon()
+
+    def save_commands(self, user_id, device_id, commands):
+        """Record a device's command queue (any iterable of command dicts); an empty one is deleted"""
+        self._commands[(user_id, device_id)] = commands
+        self._flush_soon()
+
+    def _flush_soon(self):
+        # Without the background task (e.g. lifespan not run) flush from the event loop instead
+        if self._task is not None or time.monotonic() - self._last_flush < self.flush_interval:
+            return
+        if self._fallback_flush is not None and not self._fallback_flush.done():
+            return  # The previous one is still writing
+        self._last_flush = time.monotonic()
+        self._fallback_flush = asyncio.get_running_loop().create_task(self.flush())
+
+    def delete_device(self, user_id, device_id):
+        key = (user_id, device_id)
+        self._snapshots.pop(key, None)
+        self._commands.pop(key, None)
+        self._chunks = [c for c in self._chunks if (c[0], c[1]) != key]
+        self._deleted.add(key)
+
+    # --- Committing ---
+    async def flush(self, prune=False):
+        """Commit recorded changes; with prune, also delete history past its retention"""
+        self._last_flush = time.monotonic()
+        # Serialize on the event loop so handlers can't mutate what is being written
+        deleted, self._deleted = self._deleted, set()
+        snapshots, self._snapshots = self._snapshots, {}
+        commands, self._commands = self._commands, {}
+        if self._history is not None:
+            self._chunks += self._history.take_changes()
+        chunks, self._chunks = self._chunks, []
+        batch = {
+            "deleted": list(deleted),
+            "snapshots": [(u, d, json.dumps(s, default=str)) for (u, d), s in snapshots.items()],
+            "commands": [(u, d, json.dumps(list(c), default=str)) for (u, d), c in commands.items() if len(c)],
+            "cleared": [key for key, c in commands.items() if not len(c)],
+            "chunks": chunks,
+            "prune": None
+        }
+        if prune and self._history is not None:
+            now = time.time()
+            batch["prune"] = {
+                width: now - seconds - self._history.chunk_span(width)
+                for width, seconds in self._history.retention().items()
+            }
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, batch)
+        except sqlite3.Error as e:
+            print(f"Warning: Could not persist server state: {e}")
+            # Retry on the next flush unless newer state has arrived meanwhile
+            self._deleted |= deleted
+            for key, value in snapshots.items():
+                self._snapshots.setdefault(key, value)
+            for key, value in commands.items():
+                self._commands.setdefault(key, value)
+            # Older rows first, so newer state for the same chunk replaces them
+            self._chunks[:0] = chunks
+
+    def _write(self, batch):
+        with self._conn:
+            for user_id, device_id in batch["deleted"]:
+                for table in ("snapshots", "commands", "chunks"):
+                    self._conn.execute(
+                        f"DELETE FROM {table} WHERE user_id = ? AND device_id = ?", (user_id, device_id)
+                    )
+            self._conn.executemany("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)", batch["snapshots"])
+            self._conn.executemany("INSERT OR REPLACE INTO commands VALUES (?, ?, ?)", batch["commands"])
+            self._conn.executemany("DELETE FROM commands WHERE user_id = ? AND device_id = ?", batch["cleared"])
+            self._conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)", batch["chunks"])
+            if batch["prune"] is not None:
+                for width, cutoff in batch["prune"].items():
+                    self._conn.execute("DELETE FROM chunks WHERE width = ? AND start < ?", (width, cutoff))
+
+    async def _run(self):
+        last_prune = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            prune = time.monotonic() - last_prune >= self.prune_interval
+            if prune:
+                last_prune = time.monotonic()
+            await self.flush(prune)
+
+    def start(self, history):
+        self._history = history
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        self._executor.shutdown()
+        self._conn.close()
+
+    # --- Startup ---
+    def load(self, device_stats, command_queue, history):
+        """Bulk-load persisted state into the server's in-memory structures"""
+        started = time.monotonic()
+        for user_id, device_id, data in self._conn.execute("SELECT * FROM snapshots"):
+            snapshot = json.loads(data)
+            snapshot["status"] = "Offline"  # Until the agent reports again
+            device_stats.setdefault(user_id, {})[device_id] = snapshot
+        for user_id, device_id, data in self._conn.execute("SELECT * FROM commands"):
+            command_queue.setdefault(user_id, {})[device_id] = json.loads(data)
+
+        chunk_count = 0
+        rows = self._conn.execute(
+            "SELECT user_id, device_id, metric, width, data FROM chunks ORDER BY user_id, device_id, metric, width, start"
+        )
+        for row in rows:
+            history.load_chunk(*row)
+            chunk_count += 1
+
+        device_count = sum(len(devices) for devices in device_stats.values())
+        print(f"📦 Loaded {device_count} devices and {chunk_count} history chunks "
+              f"from {self.path} in {time.monotonic() - started:.2f}s")
+
+def open_store(path):
+    """Open the SQLite store at path, or a NullStore when it is unset or unusable"""
+    if not path:
+        return NullStore()
+    try:
+        return SQLiteStore(path)
+    except sqlite3.Error as e:
+        print(f"⚠️ State store {path} unavailable, running without persistence: {e}")
+        return NullStore()
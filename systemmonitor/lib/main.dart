@@ -93,6 +93,7 @@ class _SystemMonitorPageState extends State<SystemMonitorPage> {
   bool _isLoading = true;
   String? _error;
   DateTime? _lastUpdate;
+  String? _statsEtag;
   String? _selectedDeviceId;
   List<Map<String, dynamic>> _devices = [];
 
@@ -136,7 +137,7 @@ class _SystemMonitorPageState extends State<SystemMonitorPage> {
     try {
       final headers = await _getAuthHeaders();
       final response = await http.get(
-        Uri.parse('$baseUrl/devices'),
+        Uri.parse('$baseUrl/devices?shape=summary'),
         headers: headers,
       );
 
@@ -160,12 +161,20 @@ class _SystemMonitorPageState extends State<SystemMonitorPage> {
 
     try {
       final headers = await _getAuthHeaders();
+      if (_statsEtag != null) headers['If-None-Match'] = _statsEtag!;
       final response = await http.get(
         Uri.parse('$baseUrl/status'),
         headers: headers,
       );
 
-      if (response.statusCode == 200) {
+      if (response.statusCode == 304) {
+        // Snapshot unchanged since the last poll
+        setState(() {
+          _error = null;
+          _lastUpdate = DateTime.now();
+        });
+      } else if (response.statusCode == 200) {
+        _statsEtag = response.headers['etag'];
         setState(() {
           stats = json.decode(response.body);
           _isLoading = false;
@@ -200,6 +209,7 @@ class _SystemMonitorPageState extends State<SystemMonitorPage> {
                 onSelected: (deviceId) {
                   setState(() {
                     _selectedDeviceId = deviceId;
+                    _statsEtag = null;
                     fetchStats();
                   });
                 },
@@ -3,6 +3,7 @@ import 'package:flutter/services.dart';
 import 'package:http/http.dart' as http;
 import 'dart:async';
 import 'dart:convert';
+import 'dart:math';
 import 'auth_service.dart';
 import 'login_page.dart';
 
@@ -38,7 +39,7 @@ class _RemoteControlPageState extends State<RemoteControlPage> {
     try {
       final headers = await _getAuthHeaders();
       final response = await http.get(
-        Uri.parse('$baseUrl/devices'),
+        Uri.parse('$baseUrl/devices?shape=summary'),
         headers: headers,
       );
 
@@ -83,12 +84,20 @@ class _RemoteControlPageState extends State<RemoteControlPage> {
     setState(() => _isLoading = true);
 
     try {
+      // Same key on every attempt, so a retried request is not queued twice.
+      // 1 << 31 keeps nextInt's bound valid on the web, where ints are 32-bit
+      // in shifts.
+      final idempotencyKey =
+          '${DateTime.now().microsecondsSinceEpoch}-${Random.secure().nextInt(1 << 31)}';
       final headers = await _getAuthHeaders();
-      final response = await http.post(
-        Uri.parse('$baseUrl/command?target_device_id=$_selectedDeviceId'),
-        headers: headers,
-        body: json.encode({'command': command, 'params': params ?? {}}),
-      );
+      headers['Idempotency-Key'] = idempotencyKey;
+      http.Response response;
+      try {
+        response = await _postCommand(command, params, headers);
+      } on Exception {
+        // Connection dropped before a response: retry once
+        response = await _postCommand(command, params, headers);
+      }
 
       if (response.statusCode == 200) {
         if (mounted) {
@@ -118,6 +127,20 @@ class _RemoteControlPageState extends State<RemoteControlPage> {
     }
   }
 
+  Future<http.Response> _postCommand(
+    String command,
+    Map<String, dynamic>? params,
+    Map<String, String> headers,
+  ) {
+    return http
+        .post(
+          Uri.parse('$baseUrl/command?target_device_id=$_selectedDeviceId'),
+          headers: headers,
+          body: json.encode({'command': command, 'params': params ?? {}}),
+        )
+        .timeout(const Duration(seconds: 15));
+  }
+
   Future<bool> confirmAction(String title, String message) async {
     return await showDialog<bool>(
           context: context,